@@ -1,7 +1,9 @@
 import boto3
+import json
 import os
+import re
 from dotenv import load_dotenv
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 # 環境変数を読み込み
 load_dotenv('.env.aurora')
@@ -12,24 +14,92 @@ AURORA_SECRET_ARN = os.getenv('AURORA_SECRET_ARN')
 AURORA_DATABASE = os.getenv('AURORA_DATABASE')
 AWS_REGION = os.getenv('AWS_REGION')
 
+# 複数行の INSERT/UPDATE を1リクエストにまとめるときの上限
+# （Data API のリクエストサイズ上限より十分小さくしておく）
+DATA_API_MAX_PAYLOAD_BYTES = int(os.getenv('DATA_API_MAX_PAYLOAD_BYTES', str(2 * 1024 * 1024)))
+DATA_API_MAX_ROWS = int(os.getenv('DATA_API_MAX_ROWS', '500'))
+
 # RDS Data APIクライアント
 rds_data = boto3.client('rds-data', region_name=AWS_REGION)
 
-def execute_sql(sql: str, parameters: List[Dict[str, Any]] = None) -> Dict[str, Any]:
-    """SQLを実行して結果を返す"""
+def execute_sql(sql: str, parameters: List[Dict[str, Any]] = None,
+                transaction_id: Optional[str] = None) -> Dict[str, Any]:
+    """SQLを実行して結果を返す（transaction_id を渡すとそのトランザクション内で実行）"""
     try:
+        kwargs = {"transactionId": transaction_id} if transaction_id else {}
         response = rds_data.execute_statement(
             resourceArn=AURORA_CLUSTER_ARN,
             secretArn=AURORA_SECRET_ARN,
             database=AURORA_DATABASE,
             sql=sql,
-            parameters=parameters or []
+            parameters=parameters or [],
+            **kwargs
         )
         return response
     except Exception as e:
         print(f'SQL実行エラー: {e}')
         raise e
 
+def begin_transaction() -> str:
+    """トランザクションを開始して ID を返す"""
+    response = rds_data.begin_transaction(
+        resourceArn=AURORA_CLUSTER_ARN,
+        secretArn=AURORA_SECRET_ARN,
+        database=AURORA_DATABASE
+    )
+    return response['transactionId']
+
+def commit_transaction(transaction_id: str):
+    rds_data.commit_transaction(
+        resourceArn=AURORA_CLUSTER_ARN,
+        secretArn=AURORA_SECRET_ARN,
+        transactionId=transaction_id
+    )
+
+def rollback_transaction(transaction_id: str):
+    rds_data.rollback_transaction(
+        resourceArn=AURORA_CLUSTER_ARN,
+        secretArn=AURORA_SECRET_ARN,
+        transactionId=transaction_id
+    )
+
+def execute_values(sql: str, row_sql: str, rows: List[Dict[str, Dict[str, Any]]],
+                   transaction_id: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+    """複数行を VALUES にまとめて実行し、全リクエストの records をつなげて返す
+
+    sql の {values} を row_sql（例: "(:content, :content_hash)"）を行数分並べたものに置き換える。
+    rows は行ごとの パラメータ名 -> 値（{"stringValue": ...} など）。
+    1リクエストの SQL とパラメータが DATA_API_MAX_PAYLOAD_BYTES・DATA_API_MAX_ROWS を
+    超えないよう分割して実行する。
+    """
+    if not rows:
+        return []
+    names = sorted(rows[0], key=len, reverse=True)
+    pattern = re.compile(r"(?<!:):(" + "|".join(re.escape(name) for name in names) + r")\b")
+
+    records: List[List[Dict[str, Any]]] = []
+    batch_sql: List[str] = []
+    batch_parameters: List[Dict[str, Any]] = []
+    size = len(sql)
+
+    def flush():
+        if batch_sql:
+            result = execute_sql(sql.replace("{values}", ", ".join(batch_sql)), batch_parameters, transaction_id)
+            records.extend(result.get('records', []))
+
+    for row in rows:
+        row_size = len(row_sql) + sum(len(name) + len(json.dumps(value)) + 40 for name, value in row.items())
+        if batch_sql and (len(batch_sql) >= DATA_API_MAX_ROWS or size + row_size > DATA_API_MAX_PAYLOAD_BYTES):
+            flush()
+            batch_sql, batch_parameters, size = [], [], len(sql)
+        # パラメータ名に行番号を付けて行ごとに区別する
+        k = len(batch_sql)
+        batch_sql.append(pattern.sub(lambda m: f":{m.group(1)}_{k}", row_sql))
+        batch_parameters.extend({"name": f"{name}_{k}", "value": value} for name, value in row.items())
+        size += row_size
+    flush()
+    return records
+
 def get_db():
     """データベース接続の依存関数（FastAPI用）"""
     # Data APIは接続プールが不要なので、単純にyield
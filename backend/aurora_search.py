@@ -0,0 +1,213 @@
+"""
+Aurora 上でのベンダー検索
+
+絞り込みとランキングをデータベース側で行い、上位 max_results 件だけを
+Data API で受け取る。部分一致は lower(列) に張った pg_trgm の GIN インデックスで
+処理される（create_aurora_tables.create_indexes を参照）。
+
+クエリは vendor_query で解析し、AND / OR / フィールド指定をそのまま WHERE 句に
+変換する。語はすべてパラメータで渡し、SQL に埋め込むのは固定の列式だけ。
+ファセットの絞り込みは IN 条件、件数は同じ WHERE 句での GROUP BY で求める。
+
+一致するベンダーがないときは、プロセス内の FuzzyNameIndex（名前・別名の
+あいまい検索）で候補IDを求め、そのIDだけをデータベースから取得する。
+
+スコアは SQL だけで計算できる簡略版で、main.py のインメモリ検索（search_index の
+n-gram BM25F）とは一致しない。共通なのはフィールド重みと、最上位を 1.0 とした相対値に
+することだけで、同じクエリでも2つのバックエンドで順位が変わりうる。
+  - フィールド重み name 0.8 / category 0.6 / description 0.4（search_index と同じ）
+  - 語ごとの出現回数 tf を tf / (k1 + tf) で飽和させて合計（k1 = 1.2）
+  - idf（語の珍しさ）とフィールド長の正規化はない
+  - 最上位を 1.0 とした相対値
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from aurora_database import execute_sql
+from fuzzy_index import FuzzyNameIndex, normalize_name
+from vendor_query import FACET_FIELDS, Term, parse_query, unique_terms, validate_filters
+
+# フィールド -> 検索に使う列式（インデックスの式と一致させる）
+FIELD_COLUMNS = {
+    "name": "lower(name)",
+    "category": "lower(category)",
+    "description": "lower(coalesce(description, ''))",
+}
+
+FIELD_WEIGHTS = {
+    "name": 0.8,
+    "category": 0.6,
+    "description": 0.4,
+}
+
+TF_K1 = 1.2
+
+
+def like_pattern(query: str) -> str:
+    """部分一致用の LIKE パターン（% _ \\ をエスケープ）"""
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def build_where(groups: List[List[Term]], filters: Dict[str, List[str]],
+                exclude: Optional[str] = None) -> Tuple[str, List[Dict[str, Any]]]:
+    """クエリとファセット条件から WHERE 句と Data API パラメータを組み立てる
+
+    語 i の LIKE パターンは :p{i} として渡す。
+    """
+    terms = unique_terms(groups)
+    term_index = {term: i for i, term in enumerate(terms)}
+
+    parameters = []
+    for i, term in enumerate(terms):
+        parameters.append({"name": f"p{i}", "value": {"stringValue": like_pattern(term.text)}})
+
+    def term_condition(term: Term) -> str:
+        i = term_index[term]
+        return "(" + " OR ".join(f"{FIELD_COLUMNS[field]} LIKE :p{i}" for field in term.fields) + ")"
+
+    conditions = ["is_active = true"]
+    if groups:
+        conditions.append("(" + " OR ".join(
+            "(" + " AND ".join(term_condition(term) for term in group) + ")"
+            for group in groups
+        ) + ")")
+
+    for field, values in filters.items():
+        # 値のない条件は絞り込まない（IN () は SQL として不正）
+        if field == exclude or not values:
+            continue
+        names = []
+        for j, value in enumerate(values):
+            names.append(f":f_{field}_{j}")
+            parameters.append({"name": f"f_{field}_{j}", "value": {"stringValue": value}})
+        conditions.append(f"{field} IN ({', '.join(names)})")
+
+    return " AND ".join(conditions), parameters
+
+
+def build_search_sql(groups: List[List[Term]], filters: Dict[str, List[str]],
+                     max_results: int) -> Tuple[str, List[Dict[str, Any]]]:
+    """解析済みクエリから検索 SQL と Data API パラメータを組み立てる"""
+    where, parameters = build_where(groups, filters)
+
+    tf_columns = []
+    score_parts = []
+    for i, term in enumerate(unique_terms(groups)):
+        parameters.append({"name": f"q{i}", "value": {"stringValue": term.text}})
+        for field in term.fields:
+            column = FIELD_COLUMNS[field]
+            alias = f"tf_{i}_{field}"
+            tf_columns.append(
+                f"(char_length({column}) - char_length(replace({column}, :q{i}, '')))::float"
+                f" / char_length(:q{i}) AS {alias}"
+            )
+            score_parts.append(f"{FIELD_WEIGHTS[field]} * {alias} / ({TF_K1} + {alias})")
+    parameters.append({"name": "limit", "value": {"longValue": max_results}})
+
+    sql = f"""
+SELECT name, category, description, website_url,
+       score / MAX(score) OVER () AS score
+FROM (
+    SELECT id, name, category, description, website_url,
+           {" + ".join(score_parts)} AS score
+    FROM (
+        SELECT id, name, category, description, website_url,
+               {", ".join(tf_columns)}
+        FROM vendors
+        WHERE {where}
+    ) matched
+) scored
+ORDER BY score DESC, id
+LIMIT :limit
+"""
+    return sql, parameters
+
+
+def search_vendors(query: str, max_results: int,
+                   filters: Optional[Dict[str, List[str]]] = None) -> List[dict]:
+    """クエリに一致するベンダーをスコア順に上位 max_results 件返す"""
+    groups = parse_query(query)
+    filters = validate_filters(filters)
+    if not groups or max_results <= 0:
+        return []
+
+    sql, parameters = build_search_sql(groups, filters, max_results)
+    result = execute_sql(sql, parameters)
+
+    hits = []
+    for record in result.get('records', []):
+        hits.append({
+            "vendor_name": record[0]['stringValue'],
+            "category": record[1]['stringValue'],
+            "description": record[2].get('stringValue') or "説明なし",
+            "website_url": record[3].get('stringValue'),
+            "score": float(record[4]['doubleValue']),
+        })
+    return hits
+
+
+def fuzzy_search(name_index: FuzzyNameIndex, query: str, max_results: int,
+                 filters: Optional[Dict[str, List[str]]] = None) -> List[dict]:
+    """名前・別名のあいまい検索（スコアは 1 - 距離 / 文字数）"""
+    matches = name_index.lookup(query)
+    filters = validate_filters(filters)
+    if not matches or max_results <= 0:
+        return []
+
+    where, parameters = build_where([], filters)
+    id_names = []
+    for j, (vendor_id, _, _) in enumerate(matches):
+        id_names.append(f":id{j}")
+        parameters.append({"name": f"id{j}", "value": {"longValue": vendor_id}})
+    result = execute_sql(
+        f"SELECT id, name, category, description, website_url FROM vendors "
+        f"WHERE {where} AND id IN ({', '.join(id_names)})",
+        parameters
+    )
+    records = {record[0]['longValue']: record for record in result.get('records', [])}
+
+    query_length = len(normalize_name(query))
+    hits = []
+    for vendor_id, distance, name in matches:
+        record = records.get(vendor_id)
+        if record is None:
+            continue
+        hits.append({
+            "vendor_name": record[1]['stringValue'],
+            "category": record[2]['stringValue'],
+            "description": record[3].get('stringValue') or "説明なし",
+            "website_url": record[4].get('stringValue'),
+            "score": 1.0 - distance / max(query_length, len(name)),
+        })
+        if len(hits) >= max_results:
+            break
+    return hits
+
+
+def facet_counts(query: Optional[str] = None,
+                 filters: Optional[Dict[str, List[str]]] = None) -> dict:
+    """ヒット件数とファセットごとの値別件数（クエリなしは全ベンダーが対象）
+
+    各ファセットの件数はそのファセット自身の絞り込みを除いて数える。
+    """
+    groups = parse_query(query) if query else []
+    filters = validate_filters(filters)
+
+    where, parameters = build_where(groups, filters)
+    result = execute_sql(f"SELECT count(*) FROM vendors WHERE {where}", parameters)
+    total = result['records'][0][0]['longValue']
+
+    facets = {}
+    for field in FACET_FIELDS:
+        where, parameters = build_where(groups, filters, exclude=field)
+        result = execute_sql(
+            f"SELECT {field}, count(*) AS hits FROM vendors WHERE {where} "
+            f"GROUP BY {field} ORDER BY hits DESC, {field}",
+            parameters
+        )
+        facets[field] = {
+            record[0]['stringValue']: record[1]['longValue']
+            for record in result.get('records', [])
+        }
+
+    return {"total": total, "facets": facets}
@@ -0,0 +1,146 @@
+"""
+文単位のストリーミングチャンカー
+
+入力テキストを断片（str）の列として受け取り、文末（。！？と改行）で区切った文を
+トークン予算 max_tokens に収まるだけ詰めてチャンクにする。前のチャンクの末尾から
+overlap_tokens 以内の文を次のチャンクの先頭に重ねる。
+すべてジェネレータなので、保持するのは読み込み中のブロックと未完成の文と
+作成中のチャンクだけで、文書全体の大きさに関係なくメモリは一定になる。
+"""
+import codecs
+import os
+import re
+from collections import deque
+from itertools import islice
+from typing import Deque, Iterable, Iterator, List, Tuple, TypeVar
+
+# 1チャンクの推定トークン数の上限と、前のチャンクと重ねる推定トークン数
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "500"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "50"))
+
+# チャンクの切り方の版（分割規則を変えたら上げる）。設定値と合わせて取り込み記録に残し、
+# 変わっていれば同じファイルでも取り込み直す
+CHUNKER_REVISION = 1
+CHUNKER_VERSION = f"{CHUNKER_REVISION}:{CHUNK_MAX_TOKENS}:{CHUNK_OVERLAP_TOKENS}"
+
+# 文末のないまま溜められる最大文字数（超えたら文として切り出す）
+MAX_SENTENCE_CHARS = 8192
+
+# ファイルを読み込む1ブロックのバイト数
+INGEST_READ_BYTES = int(os.getenv("INGEST_READ_BYTES", str(1024 * 1024)))
+
+# 文末（続く閉じ括弧も文に含める）
+_SENTENCE_END = re.compile(r"[。！？\n]+[」』）)]*")
+
+T = TypeVar("T")
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の控えめな見積もり（日本語は1文字≒1トークン、英語は約4バイト≒1トークン）"""
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+def batched(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """size 件ずつのリストに分けて返す"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def decode_stream(blocks: Iterable[bytes], errors: str = "strict") -> Iterator[str]:
+    """バイト列のブロックを UTF-8 として順にデコードする（ブロック境界で割れた文字も正しく扱う）"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors)
+    for block in blocks:
+        text = decoder.decode(block)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def read_blocks(file, size: int = INGEST_READ_BYTES) -> Iterator[bytes]:
+    """ファイルオブジェクトを size バイトずつ読む"""
+    return iter(lambda: file.read(size), b"")
+
+
+def split_sentences(pieces: Iterable[str]) -> Iterator[str]:
+    """断片の列を文の列にする（文末記号は文に含める）
+
+    MAX_SENTENCE_CHARS を超える文は、文の先頭（直前の文末）から MAX_SENTENCE_CHARS ごとに
+    切るので、断片の区切り方によらず同じ位置で切れる。
+    """
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        position = 0
+        for match in _SENTENCE_END.finditer(buffer):
+            # 断片の末尾にかかる文末は、次の断片に続きがあるかもしれないので保留する
+            if match.end() == len(buffer):
+                break
+            while match.end() - position > MAX_SENTENCE_CHARS:
+                yield buffer[position:position + MAX_SENTENCE_CHARS]
+                position += MAX_SENTENCE_CHARS
+            yield buffer[position:match.end()]
+            position = match.end()
+        buffer = buffer[position:]
+        # 文末がまだ来ていない部分も、長すぎる分は同じ位置で先に切り出す
+        while len(buffer) > MAX_SENTENCE_CHARS:
+            yield buffer[:MAX_SENTENCE_CHARS]
+            buffer = buffer[MAX_SENTENCE_CHARS:]
+    if buffer:
+        yield buffer
+
+
+def _split_long(sentence: str, max_tokens: int) -> Iterator[str]:
+    """max_tokens を超える文を文字単位で分割"""
+    start = 0
+    size = 0
+    for i, char in enumerate(sentence):
+        char_size = len(char.encode("utf-8"))
+        if i > start and (size + char_size) // 3 + 1 > max_tokens:
+            yield sentence[start:i]
+            start, size = i, 0
+        size += char_size
+    if start < len(sentence):
+        yield sentence[start:]
+
+
+def chunk_text(pieces: Iterable[str], max_tokens: int = CHUNK_MAX_TOKENS,
+               overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[str]:
+    """断片の列から、文の区切りで max_tokens 以内に収めたチャンクを順に返す"""
+    if overlap_tokens >= max_tokens:
+        raise ValueError("overlap_tokens は max_tokens より小さくしてください")
+
+    # 作成中のチャンクの (文, 推定トークン数)
+    current: Deque[Tuple[str, int]] = deque()
+    current_tokens = 0
+    # current のうち前のチャンクから重ねた文の数（重ねた文だけのチャンクは出さない）
+    carried = 0
+
+    for sentence in split_sentences(pieces):
+        for part in _split_long(sentence, max_tokens):
+            tokens = estimate_tokens(part)
+            if current and current_tokens + tokens > max_tokens:
+                chunk = "".join(text for text, _ in current).strip()
+                if len(current) > carried and chunk:
+                    yield chunk
+                # 末尾から overlap_tokens 以内の文だけ残す
+                kept: Deque[Tuple[str, int]] = deque()
+                kept_tokens = 0
+                for text, size in reversed(current):
+                    if kept_tokens + size > overlap_tokens or kept_tokens + size + tokens > max_tokens:
+                        break
+                    kept.appendleft((text, size))
+                    kept_tokens += size
+                current, current_tokens, carried = kept, kept_tokens, len(kept)
+            current.append((part, tokens))
+            current_tokens += tokens
+
+    if len(current) > carried:
+        chunk = "".join(text for text, _ in current).strip()
+        if chunk:
+            yield chunk
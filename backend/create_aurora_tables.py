@@ -48,6 +48,7 @@ def create_tables():
         category VARCHAR(255) NOT NULL,
         description TEXT,
         website_url VARCHAR(500),
+        aliases TEXT,
         is_active BOOLEAN DEFAULT true,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
@@ -60,10 +61,47 @@ def create_tables():
         content TEXT NOT NULL,
         embedding vector(1536),
         metadata JSONB,
+        content_hash TEXT,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
     """
     
+    # 既存の documents に content_hash を追加して埋め、同じ本文の行は1行だけ残す（埋め込みのある行・古い行を優先）
+    documents_content_hash_sqls = [
+        "ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash TEXT;",
+        """
+        UPDATE documents SET content_hash = encode(sha256(convert_to(content, 'UTF8')), 'hex')
+        WHERE content_hash IS NULL;
+        """,
+        """
+        DELETE FROM documents d USING documents keep
+        WHERE d.content_hash = keep.content_hash
+          AND (d.embedding IS NULL, d.id) > (keep.embedding IS NULL, keep.id);
+        """,
+    ]
+    
+    # 文書ごとの取り込み記録（S3 の ETag・チャンカーの版）と、文書に含まれるチャンクの content_hash
+    # 変更のない文書の再取り込みを省略し、変更された文書からなくなったチャンクを削除するのに使う
+    document_manifests_table_sqls = [
+        """
+        CREATE TABLE IF NOT EXISTS document_manifests (
+            s3_key TEXT PRIMARY KEY,
+            etag TEXT,
+            version_id TEXT,
+            chunker_version TEXT NOT NULL,
+            chunk_count INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS document_manifest_chunks (
+            s3_key TEXT NOT NULL REFERENCES document_manifests (s3_key) ON DELETE CASCADE,
+            content_hash TEXT NOT NULL,
+            PRIMARY KEY (s3_key, content_hash)
+        );
+        """,
+    ]
+    
     try:
         print("Starting table creation...")
         
@@ -75,13 +113,22 @@ def create_tables():
         # Create vendors table
         print("Creating vendors table...")
         execute_sql(vendors_table_sql)
+        execute_sql("ALTER TABLE vendors ADD COLUMN IF NOT EXISTS aliases TEXT;")
         print("✅ vendors table created successfully")
         
         # Create documents table
         print("Creating documents table...")
         execute_sql(documents_table_sql)
+        for content_hash_sql in documents_content_hash_sqls:
+            execute_sql(content_hash_sql)
         print("✅ documents table created successfully")
         
+        # Create document manifest tables
+        print("Creating document manifest tables...")
+        for manifest_sql in document_manifests_table_sqls:
+            execute_sql(manifest_sql)
+        print("✅ document manifest tables created successfully")
+        
         print("\n🎉 All tables created successfully!")
         
     except Exception as e:
@@ -97,11 +144,51 @@ def create_indexes():
     ON documents USING ivfflat (embedding vector_cosine_ops);
     """
     
+    # One row per chunk content (ingest uses ON CONFLICT (content_hash) DO NOTHING)
+    content_hash_index_sql = """
+    CREATE UNIQUE INDEX IF NOT EXISTS documents_content_hash_idx
+    ON documents (content_hash);
+    """
+    
+    # Look up which documents still contain a chunk before deleting it
+    manifest_chunks_index_sql = """
+    CREATE INDEX IF NOT EXISTS document_manifest_chunks_content_hash_idx
+    ON document_manifest_chunks (content_hash);
+    """
+    
+    # Vendor search indexes (substring LIKE on lower(column) via pg_trgm)
+    trgm_extension_sql = "CREATE EXTENSION IF NOT EXISTS pg_trgm;"
+    vendor_trgm_index_sqls = [
+        """
+        CREATE INDEX IF NOT EXISTS vendors_name_trgm_idx
+        ON vendors USING gin (lower(name) gin_trgm_ops);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS vendors_category_trgm_idx
+        ON vendors USING gin (lower(category) gin_trgm_ops);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS vendors_description_trgm_idx
+        ON vendors USING gin (lower(coalesce(description, '')) gin_trgm_ops);
+        """,
+    ]
+    
     try:
         print("Starting index creation...")
         execute_sql(vector_index_sql)
         print("✅ Vector search index created successfully")
         
+        execute_sql(content_hash_index_sql)
+        print("✅ Content hash index created successfully")
+        
+        execute_sql(manifest_chunks_index_sql)
+        print("✅ Manifest chunk index created successfully")
+        
+        execute_sql(trgm_extension_sql)
+        for index_sql in vendor_trgm_index_sqls:
+            execute_sql(index_sql)
+        print("✅ Vendor search indexes created successfully")
+        
     except Exception as e:
         print(f"❌ Index creation error: {e}")
         raise e
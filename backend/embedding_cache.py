@@ -0,0 +1,175 @@
+"""
+検索クエリの埋め込みキャッシュ
+
+(モデル名, 正規化したクエリ) をキーに、メモリ上の LRU とディスク上の SQLite の
+2段で埋め込みを保持する。ディスク側は再起動後も残り、最後に使った時刻が古いものから
+max_disk_entries 件を超えた分を削除する。最後に使った時刻はヒットのたびには書かず、
+メモリに溜めて put のときか touch_batch_size 件たまったときにまとめて書く。
+同じクエリの2回目以降は OpenAI を呼ばずに済む。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def normalize_query(text: str) -> str:
+    """全角半角・空白の違いを吸収（大文字小文字は埋め込みが変わりうるので残す）"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def content_hash(text: str) -> str:
+    """チャンク本文の SHA-256（同じ内容の埋め込みを使い回すためのキー）"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """メモリ LRU + SQLite の2段キャッシュ"""
+
+    def __init__(self, model: str, max_entries: int = 1024,
+                 path: Optional[str] = None, max_disk_entries: int = 100000,
+                 touch_batch_size: int = 256):
+        self.model = model
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.touch_batch_size = touch_batch_size
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, List[float]]" = OrderedDict()
+        # ディスクにまだ書いていない最後に使った時刻
+        self._touched: Dict[str, float] = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._disk_entries = 0
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS query_embeddings (
+                    model TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, text)
+                )
+                """
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS query_embeddings_last_used ON query_embeddings (last_used)")
+            self._db.commit()
+            self._disk_entries = self._db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+
+    def _remember(self, text: str, embedding: List[float]):
+        if self.max_entries <= 0:
+            return
+        self._entries[text] = embedding
+        self._entries.move_to_end(text)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _touch(self, text: str):
+        if self._db is None:
+            return
+        self._touched[text] = time.time()
+        if len(self._touched) >= self.touch_batch_size:
+            self._flush_touched()
+            self._db.commit()
+
+    def _flush_touched(self):
+        if not self._touched:
+            return
+        self._db.executemany(
+            "UPDATE query_embeddings SET last_used = ? WHERE model = ? AND text = ?",
+            [(used, self.model, text) for text, used in self._touched.items()],
+        )
+        self._touched.clear()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        """キャッシュから取得（なければ None）。text は normalize_query 済みのもの"""
+        with self._lock:
+            embedding = self._entries.get(text)
+            if embedding is not None:
+                self._entries.move_to_end(text)
+                self._touch(text)
+                self.memory_hits += 1
+                return embedding
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT embedding FROM query_embeddings WHERE model = ? AND text = ?",
+                    (self.model, text),
+                ).fetchone()
+                if row is not None:
+                    self._touch(text)
+                    embedding = np.frombuffer(row[0], dtype=np.float32).tolist()
+                    self._remember(text, embedding)
+                    self.disk_hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, text: str, embedding: List[float]):
+        """メモリとディスクに保存し、ディスクの上限を超えた古いものを削除"""
+        with self._lock:
+            self._remember(text, embedding)
+            if self._db is None:
+                return
+
+            # 古いものを削除する前に、溜めておいた最後に使った時刻を反映する
+            self._touched.pop(text, None)
+            self._flush_touched()
+            self._db.execute(
+                "INSERT OR REPLACE INTO query_embeddings (model, text, embedding, last_used) VALUES (?, ?, ?, ?)",
+                (self.model, text, np.asarray(embedding, dtype=np.float32).tobytes(), time.time()),
+            )
+            self._disk_entries += 1
+            if self._disk_entries > self.max_disk_entries:
+                # 置き換えだった場合は数えすぎているので数え直す
+                self._disk_entries = self._db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+            overflow = self._disk_entries - self.max_disk_entries
+            if overflow > 0:
+                self._db.execute(
+                    "DELETE FROM query_embeddings WHERE rowid IN "
+                    "(SELECT rowid FROM query_embeddings ORDER BY last_used LIMIT ?)",
+                    (overflow,),
+                )
+                self._disk_entries -= overflow
+            self._db.commit()
+
+    def sample(self, size: int) -> List[List[float]]:
+        """キャッシュ済みのクエリの埋め込みを最大 size 件取り出す（検索の評価用）"""
+        with self._lock:
+            if self._db is None:
+                return list(self._entries.values())[:size]
+            rows = self._db.execute(
+                "SELECT embedding FROM query_embeddings WHERE model = ? ORDER BY random() LIMIT ?",
+                (self.model, size),
+            ).fetchall()
+            return [np.frombuffer(row[0], dtype=np.float32).tolist() for row in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "model": self.model,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "disk_entries": self._disk_entries,
+                "max_disk_entries": self.max_disk_entries if self._db is not None else 0,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,90 @@
+"""
+埋め込みプロバイダ
+
+EMBEDDING_PROVIDER で切り替える。
+  - "openai": OpenAI の埋め込み API（OPENAI_API_KEY が必要）
+  - "hashing": 文字 n-gram を feature hashing した決定的な埋め込み。
+    ネットワークも API キーも不要なので、/ingest や /search/documents の
+    スループット測定・負荷試験をオフラインで行える（検索品質は OpenAI に劣る）
+"""
+import asyncio
+import unicodedata
+import zlib
+from typing import List, Optional
+
+import numpy as np
+from openai import AsyncOpenAI
+
+PROVIDERS = ("openai", "hashing")
+
+
+class EmbeddingProvider:
+    """埋め込みプロバイダの共通インターフェース"""
+
+    # キャッシュのキーに使うモデル名と、ベクトルの次元
+    model: str
+    dim: int
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """texts を1回のリクエストでベクトル化し、入力と同じ順に返す"""
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """OpenAI の埋め込み API"""
+
+    def __init__(self, api_key: str, model: str, dim: int):
+        self.model = model
+        self.dim = dim
+        self._client = AsyncOpenAI(api_key=api_key)
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        response = await self._client.embeddings.create(
+            model=self.model,
+            input=texts
+        )
+        # 応答の index で入力順に並べ直す
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        for item in response.data:
+            embeddings[item.index] = item.embedding
+        if any(embedding is None for embedding in embeddings):
+            raise ValueError("埋め込みの件数が入力と一致しません")
+        return embeddings
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """文字 1〜max_gram グラムの feature hashing による決定的な埋め込み
+
+    各 n-gram の CRC32 で次元と符号を決めて足し込み、L2 正規化する。
+    同じテキストは常に同じベクトルになり、文字列が似ているほどコサイン類似度が高い。
+    """
+
+    def __init__(self, dim: int, max_gram: int = 3):
+        self.model = f"hashing-{dim}"
+        self.dim = dim
+        self.max_gram = max_gram
+
+    def _embed_one(self, text: str) -> List[float]:
+        text = " ".join(unicodedata.normalize("NFKC", text).lower().split())
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for n in range(1, self.max_gram + 1):
+            for i in range(len(text) - n + 1):
+                h = zlib.crc32(text[i:i + n].encode("utf-8"))
+                vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        # CPU 処理なのでイベントループを止めないようスレッドで計算する
+        return await asyncio.to_thread(lambda: [self._embed_one(text) for text in texts])
+
+
+def create_provider(name: str, api_key: Optional[str], model: str, dim: int) -> Optional[EmbeddingProvider]:
+    """設定からプロバイダを作る（OpenAI で API キーがなければ None）"""
+    if name == "openai":
+        return OpenAIEmbeddingProvider(api_key, model, dim) if api_key else None
+    if name == "hashing":
+        return HashingEmbeddingProvider(dim)
+    raise ValueError(f"EMBEDDING_PROVIDER は {', '.join(PROVIDERS)} のいずれかです: {name}")
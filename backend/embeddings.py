@@ -0,0 +1,230 @@
+"""
+埋め込みベクトルの作成（main.py と main_aurora.py で共通）
+
+プロバイダ（embedding_providers）は EMBEDDING_PROVIDER で選ぶ。
+イベントループを止めずに呼び出し、同時に投げるリクエスト数は
+EMBEDDING_CONCURRENCY、1リクエストの待ち時間は EMBEDDING_TIMEOUT 秒までに制限する。
+"""
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from openai import BadRequestError
+
+from chunker import estimate_tokens
+from embedding_cache import EmbeddingCache, content_hash, normalize_query
+from embedding_providers import EmbeddingProvider, create_provider
+
+# 埋め込み設定
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+# documents.embedding（vector(1536)）とローカルストアの次元
+EMBEDDING_DIM = 1536
+# 1回の埋め込みリクエストにまとめる件数と推定トークン数の上限
+# （API の上限は 2048 件・1入力 8191 トークン・1リクエスト 300,000 トークン）
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "128"))
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000"))
+# 同時に実行する埋め込みリクエスト数と、1リクエストのタイムアウト（秒）
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "30"))
+# ingest で一度に埋め込み・保存するチャンク数（全バッチを同時に投げられる件数）
+EMBEDDING_WINDOW = EMBEDDING_BATCH_SIZE * EMBEDDING_CONCURRENCY
+
+embedding_provider: Optional[EmbeddingProvider] = create_provider(
+    EMBEDDING_PROVIDER, OPENAI_API_KEY, EMBEDDING_MODEL, EMBEDDING_DIM
+)
+
+# asyncio.Semaphore は最初に使ったイベントループに結び付くので、ループごとに作る
+_semaphore: Optional[asyncio.Semaphore] = None
+_semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+
+logger = logging.getLogger(__name__)
+
+# 検索クエリの埋め込みキャッシュ（EMBEDDING_CACHE_PATH を空にするとメモリのみ）
+query_embedding_cache = EmbeddingCache(
+    embedding_provider.model if embedding_provider else EMBEDDING_MODEL,
+    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "1024")),
+    path=os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.sqlite3"),
+    max_disk_entries=int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", "100000")),
+)
+
+
+def _request_slot() -> asyncio.Semaphore:
+    """同時リクエスト数を制限するセマフォ"""
+    global _semaphore, _semaphore_loop
+    loop = asyncio.get_running_loop()
+    if _semaphore is None or _semaphore_loop is not loop:
+        _semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        _semaphore_loop = loop
+    return _semaphore
+
+
+def _require_provider():
+    if not embedding_provider:
+        raise HTTPException(
+            status_code=500,
+            detail="OpenAI API key not configured"
+        )
+
+
+async def _embed_batch(texts: List[str]) -> List[List[float]]:
+    """1回のリクエストでまとめてベクトル化"""
+    async with _request_slot():
+        return await asyncio.wait_for(embedding_provider.embed(texts), timeout=EMBEDDING_TIMEOUT)
+
+
+async def create_embedding(text: str) -> List[float]:
+    """テキストをベクトル化"""
+    _require_provider()
+
+    try:
+        return (await _embed_batch([text]))[0]
+    except asyncio.TimeoutError:
+        logger.error(f"Embedding creation timed out after {EMBEDDING_TIMEOUT}s")
+        raise HTTPException(
+            status_code=504,
+            detail="埋め込み作成がタイムアウトしました"
+        )
+    except Exception as e:
+        logger.error(f"Embedding creation error: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"埋め込み作成エラー: {str(e)}"
+        )
+
+
+async def create_query_embedding(query: str) -> List[float]:
+    """検索クエリをベクトル化（キャッシュにあれば API を呼ばない）"""
+    text = normalize_query(query)
+    # キャッシュは SQLite を読み書きするのでイベントループの外で呼ぶ
+    embedding = await asyncio.to_thread(query_embedding_cache.get, text)
+    if embedding is None:
+        embedding = await create_embedding(text)
+        await asyncio.to_thread(query_embedding_cache.put, text, embedding)
+    return embedding
+
+
+def batch_indices(texts: List[str], max_items: int = EMBEDDING_BATCH_SIZE,
+                  max_tokens: int = EMBEDDING_BATCH_TOKENS) -> List[List[int]]:
+    """texts の添字を、件数と推定トークン数の上限に収まるバッチに分ける"""
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _is_input_error(e: Exception) -> bool:
+    """入力のどれかが原因のエラー（HTTP 400）か"""
+    return isinstance(e, BadRequestError) or getattr(e, "status_code", None) == 400
+
+
+async def _embed_with_split(texts: List[str], indices: List[int],
+                            results: List[Optional[List[float]]]):
+    """入力エラーなら半分に分けて再試行し、失敗した1件だけを None にする
+
+    タイムアウトやレート制限・サーバーエラーは入力の問題ではないので分割せず
+    （再試行はクライアントがバックオフ付きで済ませている）、そのバッチを失敗として扱う。
+    """
+    try:
+        for i, embedding in zip(indices, await _embed_batch([texts[i] for i in indices])):
+            results[i] = embedding
+    except asyncio.TimeoutError:
+        logger.warning(f"Embedding batch of {len(indices)} chunks timed out after {EMBEDDING_TIMEOUT}s")
+    except Exception as e:
+        if not _is_input_error(e):
+            logger.warning(f"Embedding batch of {len(indices)} chunks failed: {e}")
+            return
+        if len(indices) == 1:
+            logger.warning(f"Embedding creation failed for chunk {indices[0]}: {e}")
+            return
+        middle = len(indices) // 2
+        await asyncio.gather(
+            _embed_with_split(texts, indices[:middle], results),
+            _embed_with_split(texts, indices[middle:], results),
+        )
+
+
+async def create_embeddings(texts: List[str]) -> List[Optional[List[float]]]:
+    """複数のテキストをバッチでベクトル化し、入力と同じ順に返す（失敗した要素は None）
+
+    バッチは EMBEDDING_CONCURRENCY 件まで並行してリクエストする。
+    """
+    if not texts:
+        return []
+    _require_provider()
+
+    results: List[Optional[List[float]]] = [None] * len(texts)
+    await asyncio.gather(*(
+        _embed_with_split(texts, indices, results) for indices in batch_indices(texts)
+    ))
+    return results
+
+
+class WindowEmbeddings:
+    """ingest の1ウィンドウ分の埋め込み結果と件数（main.py と main_aurora.py で共通）
+
+    hashes はチャンクごとの本文のハッシュ、stored は保存済みの本文のハッシュ -> 埋め込み済みか、
+    to_embed は埋め込みを作った本文のハッシュ -> ウィンドウ内で最初に現れる位置、
+    embedded はそのハッシュ -> 埋め込み（失敗したものは None）。
+    """
+
+    def __init__(self, hashes: List[str], stored: Dict[str, bool],
+                 to_embed: Dict[str, int], embedded: Dict[str, Optional[List[float]]]):
+        self.hashes = hashes
+        self.stored = stored
+        self.to_embed = to_embed
+        self.embedded = embedded
+
+    @property
+    def embedded_count(self) -> int:
+        """今回埋め込みを作った本文の数"""
+        return sum(1 for embedding in self.embedded.values() if embedding is not None)
+
+    @property
+    def failed_count(self) -> int:
+        """埋め込みの作成に失敗した本文の数"""
+        return len(self.embedded) - self.embedded_count
+
+    @property
+    def reused_count(self) -> int:
+        """保存済み・ウィンドウ内で既出の埋め込みを使い回したチャンクの数"""
+        return sum(
+            1 for h in self.hashes if self.stored.get(h) or self.embedded.get(h) is not None
+        ) - self.embedded_count
+
+
+async def embed_window(chunks: List[str],
+                       lookup: Callable[[List[str]], Awaitable[Dict[str, bool]]],
+                       on_error: Optional[Callable[[Exception], None]] = None) -> WindowEmbeddings:
+    """チャンクの列のうち、埋め込み済みでも既出でもない本文だけをベクトル化する
+
+    lookup は本文のハッシュの一覧を受け取り、保存済みのハッシュ -> 埋め込み済みかを返す。
+    on_error を渡すと埋め込みの作成で起きた例外をそれに渡し、すべて失敗として続ける。
+    """
+    hashes = [content_hash(chunk) for chunk in chunks]
+    stored = await lookup(hashes)
+    to_embed: Dict[str, int] = {}
+    for j, h in enumerate(hashes):
+        if not stored.get(h):
+            to_embed.setdefault(h, j)
+
+    try:
+        embeddings = await create_embeddings([chunks[j] for j in to_embed.values()])
+    except Exception as e:
+        if on_error is None:
+            raise
+        on_error(e)
+        embeddings = [None] * len(to_embed)
+    return WindowEmbeddings(hashes, stored, to_embed, dict(zip(to_embed, embeddings)))
@@ -0,0 +1,163 @@
+"""
+ベンダー名・別名のあいまい検索（SymSpell 方式）
+
+登録時に各名前の先頭 PREFIX_LENGTH 文字から最大 MAX_DISTANCE 文字を削除した文字列を
+索引しておき、検索時はクエリ側の削除文字列と突き合わせて候補を集める。候補だけを
+OSA 距離（隣接文字の入れ替えを1とする編集距離）で文字列全体について検証するので、
+全ベンダーとの編集距離計算は行わない。削除文字列の数は先頭だけで作るので名前の長さによらない。
+MAX_QUERY_LENGTH 文字を超えるクエリは綴り間違いとはみなさず、あいまい検索しない。
+
+短い名前ほど許容距離を小さくする（2文字以下は完全一致のみ、5文字以下は距離1）。
+"""
+import re
+import threading
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+MAX_DISTANCE = 2
+PREFIX_LENGTH = 7
+MAX_QUERY_LENGTH = 64
+
+_ALIAS_SEPARATOR = re.compile(r"[,、，/／]")
+
+
+def normalize_name(text: str) -> str:
+    """全角半角・大文字小文字・空白の違いを吸収"""
+    return " ".join(unicodedata.normalize("NFKC", text).lower().split())
+
+
+def split_aliases(aliases: Optional[str]) -> List[str]:
+    """「ハブル,Hubble Inc」形式の別名をリストに分割"""
+    if not aliases:
+        return []
+    return [alias.strip() for alias in _ALIAS_SEPARATOR.split(aliases) if alias.strip()]
+
+
+def allowed_distance(text: str) -> int:
+    """文字列長に応じた許容編集距離"""
+    if len(text) <= 2:
+        return 0
+    if len(text) <= 5:
+        return 1
+    return MAX_DISTANCE
+
+
+def deletes(text: str, distance: int) -> Set[str]:
+    """text から distance 文字以内を削除した文字列の集合（text 自身を含む）"""
+    results = {text}
+    frontier = {text}
+    for _ in range(distance):
+        next_frontier = set()
+        for word in frontier:
+            for i in range(len(word)):
+                next_frontier.add(word[:i] + word[i + 1:])
+        next_frontier -= results
+        results |= next_frontier
+        frontier = next_frontier
+    return results
+
+
+def prefix_deletes(text: str) -> Set[str]:
+    """索引・検索に使う削除文字列（先頭 PREFIX_LENGTH 文字から、文字列長に応じた距離まで）"""
+    return deletes(text[:PREFIX_LENGTH], allowed_distance(text))
+
+
+def osa_distance(a: str, b: str, max_distance: int) -> int:
+    """OSA 距離（max_distance を超えたら max_distance + 1 を返す）"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous2: List[int] = []
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+class FuzzyNameIndex:
+    """ベンダー名・別名の削除文字列インデックス"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # 削除文字列 -> 正規化済みの名前（ほとんど1件なので set より小さい list で持つ）
+        self._deletes: Dict[str, List[str]] = {}
+        # 正規化済みの名前 -> vendor_id の集合
+        self._names: Dict[str, Set[int]] = {}
+        # vendor_id -> 正規化済みの名前
+        self._vendor_names: Dict[int, Set[str]] = {}
+
+    def add(self, vendor_id: int, names: Iterable[str]):
+        """ベンダーの名前と別名を登録（同じIDがあれば置き換え）"""
+        with self._lock:
+            self.remove(vendor_id)
+            normalized = {normalize_name(name) for name in names if name}
+            normalized.discard("")
+            self._vendor_names[vendor_id] = normalized
+
+            for name in normalized:
+                vendor_ids = self._names.setdefault(name, set())
+                if not vendor_ids:
+                    for deleted in prefix_deletes(name):
+                        self._deletes.setdefault(deleted, []).append(name)
+                vendor_ids.add(vendor_id)
+
+    def remove(self, vendor_id: int):
+        """ベンダーを削除"""
+        with self._lock:
+            for name in self._vendor_names.pop(vendor_id, set()):
+                vendor_ids = self._names.get(name)
+                if vendor_ids is None:
+                    continue
+                vendor_ids.discard(vendor_id)
+                if vendor_ids:
+                    continue
+                del self._names[name]
+                for deleted in prefix_deletes(name):
+                    entries = self._deletes.get(deleted)
+                    if entries is None:
+                        continue
+                    if name in entries:
+                        entries.remove(name)
+                    if not entries:
+                        del self._deletes[deleted]
+
+    def clear(self):
+        with self._lock:
+            self._deletes.clear()
+            self._names.clear()
+            self._vendor_names.clear()
+
+    def lookup(self, query: str) -> List[Tuple[int, int, str]]:
+        """許容距離内の名前を持つベンダーを (vendor_id, 距離, 名前) の距離順で返す"""
+        query = normalize_name(query)
+        max_distance = allowed_distance(query)
+        if not query or len(query) > MAX_QUERY_LENGTH:
+            return []
+
+        with self._lock:
+            candidates: Set[str] = set()
+            for deleted in prefix_deletes(query):
+                candidates.update(self._deletes.get(deleted, ()))
+
+            best: Dict[int, Tuple[int, str]] = {}
+            for name in candidates:
+                limit = min(max_distance, allowed_distance(name))
+                distance = osa_distance(query, name, limit)
+                if distance > limit:
+                    continue
+                for vendor_id in self._names[name]:
+                    if vendor_id not in best or distance < best[vendor_id][0]:
+                        best[vendor_id] = (distance, name)
+
+        return sorted(
+            ((vendor_id, distance, name) for vendor_id, (distance, name) in best.items()),
+            key=lambda x: (x[1], x[0]),
+        )
@@ -0,0 +1,346 @@
+"""
+ドキュメント埋め込みのインプロセス HNSW インデックス
+
+階層ごとの近傍グラフ（Malkov & Yashunin の HNSW）を上の層から貪欲に下り、
+最下層で ef 件の候補を保ちながら探索する近似最近傍探索。
+ベクトルは L2 正規化して保持し、距離は 1 - 内積（コサイン距離）。
+距離計算は隣接リスト単位でまとめて NumPy の行列積にする。
+
+各キーには検索結果として返すペイロード（本文・メタデータ）を持たせられるので、
+検索時にデータベースへ問い合わせる必要はない。
+save()/load() でグラフごと npz に保存し、再起動時は構築し直さずに復元する。
+remove() したキーはグラフに残したまま（探索の経路として使い）、結果からだけ除く。
+取り除いたノードが全体の compact_ratio を超えたら、残りのノードでグラフを作り直す。
+"""
+import heapq
+import json
+import math
+import os
+import tempfile
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+
+class HNSWIndex:
+    """コサイン類似度の HNSW インデックス"""
+
+    def __init__(self, dim: int, m: int = 16, ef_construction: int = 100,
+                 ef_search: int = 64, seed: Optional[int] = None, compact_ratio: float = 0.2):
+        self.dim = dim
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.compact_ratio = compact_ratio
+
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._rng = np.random.default_rng(seed)
+        self._level_mult = 1.0 / math.log(m)
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._count = 0
+        self._keys: List[int] = []
+        self._payloads: List[Any] = []
+        self._nodes: Dict[int, int] = {}
+        # ノード -> 層 -> 隣接ノード
+        self._links: List[List[List[int]]] = []
+        self._entry = -1
+        self._max_level = -1
+        # remove() されたノード
+        self._removed: Set[int] = set()
+        # 追加・削除のたびに増やし、保存した時点の値と比べて未保存の変更があるかを見る
+        self._version = 0
+        self._saved_version = 0
+
+    def __len__(self) -> int:
+        return self._count - len(self._removed)
+
+    def __contains__(self, key: int) -> bool:
+        node = self._nodes.get(key)
+        return node is not None and node not in self._removed
+
+    def _distances(self, vector: np.ndarray, nodes: Sequence[int]) -> np.ndarray:
+        return 1.0 - self._vectors[nodes] @ vector
+
+    def _search_layer(self, vector: np.ndarray, entry_points: List[int],
+                      ef: int, level: int) -> List[Tuple[float, int]]:
+        """level 層で近い順に最大 ef 件の (距離, ノード) を返す"""
+        visited = set(entry_points)
+        distances = self._distances(vector, entry_points).tolist()
+        candidates = list(zip(distances, entry_points))
+        heapq.heapify(candidates)
+        # 距離の符号を反転した最大ヒープ（先頭が最も遠い結果）
+        results = [(-d, n) for d, n in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -results[0][0] and len(results) >= ef:
+                break
+            neighbors = [n for n in self._links[node][level] if n not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for neighbor_distance, neighbor in zip(self._distances(vector, neighbors).tolist(), neighbors):
+                if len(results) < ef or neighbor_distance < -results[0][0]:
+                    heapq.heappush(candidates, (neighbor_distance, neighbor))
+                    heapq.heappush(results, (-neighbor_distance, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted((-d, n) for d, n in results)
+
+    def _select_neighbors(self, candidates: List[Tuple[float, int]], m: int) -> List[int]:
+        """近い順の候補から、既に選んだ近傍より自分に近いものを優先して m 個選ぶ
+
+        近傍が一方向に偏らないようにする論文のヒューリスティック。
+        足りない分は近い順に補う。
+        """
+        selected: List[int] = []
+        for distance, node in candidates:
+            if len(selected) >= m:
+                break
+            if not selected or np.all(self._vectors[selected] @ self._vectors[node] < 1.0 - distance):
+                selected.append(node)
+        if len(selected) < m:
+            chosen = set(selected)
+            selected += [n for _, n in candidates if n not in chosen][:m - len(selected)]
+        return selected
+
+    def _append(self, key: int, vector: np.ndarray, payload: Any, level: int) -> int:
+        if self._count == len(self._vectors):
+            grown = np.empty((max(1024, 2 * len(self._vectors)), self.dim), dtype=np.float32)
+            grown[:self._count] = self._vectors[:self._count]
+            self._vectors = grown
+        node = self._count
+        self._vectors[node] = vector
+        self._keys.append(key)
+        self._payloads.append(payload)
+        self._nodes[key] = node
+        self._links.append([[] for _ in range(level + 1)])
+        self._count += 1
+        return node
+
+    def add(self, key: int, vector: Sequence[float], payload: Any = None):
+        """ベクトルを追加（登録済みのキーは無視）"""
+        vector = np.asarray(vector, dtype=np.float32)
+        if vector.shape != (self.dim,):
+            raise ValueError(f"埋め込みの次元が違います: {vector.shape} != ({self.dim},)")
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+
+        with self._lock:
+            if key in self._nodes:
+                return
+            level = int(-math.log(1.0 - self._rng.random()) * self._level_mult)
+            node = self._append(key, vector, payload, level)
+            self._version += 1
+            if self._entry < 0:
+                self._entry, self._max_level = node, level
+                return
+
+            entry_points = [self._entry]
+            for layer in range(self._max_level, level, -1):
+                entry_points = [self._search_layer(vector, entry_points, 1, layer)[0][1]]
+
+            for layer in range(min(level, self._max_level), -1, -1):
+                candidates = self._search_layer(vector, entry_points, self.ef_construction, layer)
+                neighbors = self._select_neighbors(candidates, self.m)
+                self._links[node][layer] = neighbors
+
+                # 最下層だけ隣接数の上限を 2m にする
+                max_links = 2 * self.m if layer == 0 else self.m
+                for neighbor in neighbors:
+                    links = self._links[neighbor][layer]
+                    links.append(node)
+                    if len(links) > max_links:
+                        distances = self._distances(self._vectors[neighbor], links).tolist()
+                        self._links[neighbor][layer] = self._select_neighbors(
+                            sorted(zip(distances, links)), max_links
+                        )
+                entry_points = [n for _, n in candidates]
+
+            if level > self._max_level:
+                self._entry, self._max_level = node, level
+
+    def keys(self) -> np.ndarray:
+        """検索対象のキー（remove() したものを除く）"""
+        with self._lock:
+            return np.array(
+                [key for node, key in enumerate(self._keys) if node not in self._removed], dtype=np.int64
+            )
+
+    def remove(self, keys: Iterable[int]) -> int:
+        """キーを検索結果に出さないようにし、取り除いた件数を返す
+
+        取り除いたノードが compact_ratio を超えたら compact() する（保存済みの分も含む）。
+        """
+        removed = 0
+        with self._lock:
+            for key in keys:
+                node = self._nodes.get(key)
+                if node is None or node in self._removed:
+                    continue
+                self._removed.add(node)
+                self._payloads[node] = None
+                removed += 1
+            if removed:
+                self._version += 1
+            compact = len(self._removed) > self.compact_ratio * self._count
+        # 別のスレッドが作り直している最中なら、そちらに任せる
+        if compact and self._compact_lock.acquire(blocking=False):
+            try:
+                self._compact()
+            finally:
+                self._compact_lock.release()
+        return removed
+
+    def compact(self) -> int:
+        """取り除いたノードを除いてグラフを作り直し、除いたノード数を返す
+
+        作り直しは今の内容のコピーから _lock の外で行い、その間も検索・追加・削除できる。
+        その間に追加・削除されたものは、入れ替えるときに反映する。
+        """
+        with self._compact_lock:
+            return self._compact()
+
+    def _compact(self) -> int:
+        with self._lock:
+            count = self._count
+            removed = set(self._removed)
+            live = [node for node in range(count) if node not in removed]
+            vectors = self._vectors[live]
+            keys = [self._keys[node] for node in live]
+            payloads = [self._payloads[node] for node in live]
+
+        rebuilt = HNSWIndex(self.dim, m=self.m, ef_construction=self.ef_construction,
+                            ef_search=self.ef_search, compact_ratio=self.compact_ratio)
+        for key, vector, payload in zip(keys, vectors, payloads):
+            rebuilt.add(key, vector, payload)
+
+        with self._lock:
+            for node in range(count, self._count):
+                if node not in self._removed:
+                    rebuilt.add(self._keys[node], self._vectors[node], self._payloads[node])
+            rebuilt._removed = {
+                rebuilt._nodes[self._keys[node]] for node in self._removed - removed if node < count
+            }
+            for node in rebuilt._removed:
+                rebuilt._payloads[node] = None
+            self._vectors, self._count = rebuilt._vectors, rebuilt._count
+            self._keys, self._payloads, self._nodes = rebuilt._keys, rebuilt._payloads, rebuilt._nodes
+            self._links, self._entry, self._max_level = rebuilt._links, rebuilt._entry, rebuilt._max_level
+            self._removed = rebuilt._removed
+            self._version += 1
+        return len(removed)
+
+    def search(self, query: Sequence[float], k: int,
+               ef_search: Optional[int] = None) -> List[Tuple[int, float, Any]]:
+        """類似度の高い順に (キー, コサイン類似度, ペイロード) を最大 k 件返す
+
+        ef_search（候補数）を大きくするほど再現率が上がり、遅くなる。
+        """
+        vector = np.asarray(query, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+
+        with self._lock:
+            if self._entry < 0 or k <= 0:
+                return []
+            entry_points = [self._entry]
+            for layer in range(self._max_level, 0, -1):
+                entry_points = [self._search_layer(vector, entry_points, 1, layer)[0][1]]
+            ef = max(ef_search or self.ef_search, k)
+            while True:
+                candidates = self._search_layer(vector, entry_points, ef, 0)
+                results = [(d, n) for d, n in candidates if n not in self._removed]
+                # 取り除いたノードのせいで k 件に足りないときだけ、候補を倍にして探し直す
+                if len(results) >= k or len(candidates) < ef or ef >= self._count:
+                    break
+                ef *= 2
+            return [(self._keys[n], 1.0 - d, self._payloads[n]) for d, n in results[:k]]
+
+    @property
+    def modified(self) -> bool:
+        """最後の save()/load() から追加・削除されたか"""
+        return self._version != self._saved_version
+
+    def save(self, path: str):
+        """グラフ・ベクトル・ペイロードを npz に保存（一時ファイル経由で置き換え）
+
+        保存は _save_lock で1つずつ行い、古い内容で新しいファイルを上書きしないようにする。
+        _lock の間は今の内容をコピーするだけで、配列の組み立てと書き込みの間も検索・追加できる。
+        ペイロードは JSON の UTF-8 バイト列を連結し、各要素の開始位置を別に持つ。
+        """
+        with self._save_lock:
+            with self._lock:
+                version = self._version
+                count = self._count
+                params = [self.dim, self.m, self.ef_construction, self._entry, self._max_level]
+                vectors = self._vectors[:count]
+                keys = self._keys[:count]
+                payloads = self._payloads[:count]
+                levels = [len(node_links) - 1 for node_links in self._links]
+                link_counts = [len(layer) for node_links in self._links for layer in node_links]
+                links = [n for node_links in self._links for layer in node_links for n in layer]
+                removed = sorted(self._removed)
+
+            encoded = [json.dumps(p, ensure_ascii=False).encode("utf-8") for p in payloads]
+            arrays = {
+                "params": np.array(params, dtype=np.int64),
+                "vectors": vectors,
+                "keys": np.array(keys, dtype=np.int64),
+                "payloads": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+                "payload_offsets": np.cumsum([0] + [len(e) for e in encoded], dtype=np.int64),
+                "levels": np.array(levels, dtype=np.int32),
+                "link_counts": np.array(link_counts, dtype=np.int32),
+                "links": np.array(links, dtype=np.int32),
+                "removed": np.array(removed, dtype=np.int32),
+            }
+
+            directory = os.path.dirname(path) or "."
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez(f, **arrays)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self._saved_version = version
+
+    @classmethod
+    def load(cls, path: str, ef_search: int = 64) -> "HNSWIndex":
+        """save() したファイルから復元"""
+        with np.load(path) as data:
+            dim, m, ef_construction, entry, max_level = data["params"].tolist()
+            index = cls(dim, m=m, ef_construction=ef_construction, ef_search=ef_search)
+            index._vectors = data["vectors"].astype(np.float32)
+            index._count = len(index._vectors)
+            index._keys = data["keys"].tolist()
+            payloads = data["payloads"].tobytes()
+            offsets = data["payload_offsets"].tolist()
+            index._payloads = [json.loads(payloads[start:end]) for start, end in zip(offsets, offsets[1:])]
+            index._nodes = {key: node for node, key in enumerate(index._keys)}
+            index._entry, index._max_level = entry, max_level
+            index._removed = set(data["removed"].tolist())
+
+            link_counts = data["link_counts"].tolist()
+            links = data["links"].tolist()
+            position = 0
+            layer_index = 0
+            for level in data["levels"].tolist():
+                node_links = []
+                for _ in range(level + 1):
+                    count = link_counts[layer_index]
+                    node_links.append(links[position:position + count])
+                    position += count
+                    layer_index += 1
+                index._links.append(node_links)
+        return index
@@ -0,0 +1,37 @@
+"""
+語彙検索とベクトル検索の結果を Reciprocal Rank Fusion で統合する
+
+各検索器の順位 r に対して weight / (k + r) を足し合わせる（r は 1 始まり）。
+スコアの尺度が違う検索器でも順位だけで統合できる。
+
+統合後の上位 n 件には各検索器の上位 n 件しか入らないので、各検索器には
+n 件だけを問い合わせればよい。
+"""
+from typing import Any, Dict, Hashable, List, Sequence, Tuple
+
+# RRF の定数 k（元論文の既定値）
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Tuple[Hashable, Any]]],
+                           weights: Sequence[float] = None,
+                           k: int = RRF_K,
+                           limit: int = None) -> List[Tuple[Any, float]]:
+    """(キー, 値) の順位リストを統合し、(値, RRF スコア) をスコア順に返す
+
+    同じキーが複数のリストに現れた場合はスコアを合算し、値は最初に現れたものを使う。
+    """
+    if weights is None:
+        weights = [1.0] * len(rankings)
+
+    scores: Dict[Hashable, float] = {}
+    values: Dict[Hashable, Any] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, (key, value) in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+            values.setdefault(key, value)
+
+    fused = sorted(scores.items(), key=lambda x: -x[1])
+    if limit is not None:
+        fused = fused[:limit]
+    return [(values[key], score) for key, score in fused]
@@ -0,0 +1,157 @@
+"""
+ドキュメント取り込みのジョブキュー
+
+/ingest はジョブを登録してすぐにジョブ ID を返し、プロセス内のワーカーが
+順に処理する。ワーカーはイベントループ上のタスクなので、埋め込み API や
+Aurora の待ち時間の間は他のリクエストを処理できる。
+進捗（処理済みチャンク数・スループット・エラー）は get() で参照する。
+ジョブはメモリ上にだけあり、再起動すると消える。
+"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class IngestJob:
+    """1つの文書の取り込みジョブと進捗"""
+
+    def __init__(self, s3_key: str):
+        self.job_id = uuid.uuid4().hex
+        self.s3_key = s3_key
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # 前回の取り込みから変わっておらず処理を省略したか
+        self.unchanged = False
+        # 処理済みのチャンク数と、その内訳（追加・埋め込み・再利用・埋め込み失敗）
+        self.chunks_processed = 0
+        self.chunks_created = 0
+        self.chunks_embedded = 0
+        self.chunks_reused = 0
+        self.chunks_failed = 0
+        # 前回の取り込みにあって今回なくなり、削除したチャンク数
+        self.chunks_deleted = 0
+        # PDF の抽出済みページ数と、そのうちテキストを抽出できなかったページ数
+        self.pages_processed = 0
+        self.pages_failed = 0
+        self.errors: List[str] = []
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED)
+
+    def to_dict(self) -> dict:
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "job_id": self.job_id,
+            "s3_key": self.s3_key,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed_seconds": elapsed,
+            "unchanged": self.unchanged,
+            "chunks_processed": self.chunks_processed,
+            "chunks_created": self.chunks_created,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_reused": self.chunks_reused,
+            "chunks_failed": self.chunks_failed,
+            "chunks_deleted": self.chunks_deleted,
+            "chunks_per_sec": self.chunks_processed / elapsed if elapsed else 0.0,
+            "pages_processed": self.pages_processed,
+            "pages_failed": self.pages_failed,
+            "pages_per_sec": self.pages_processed / elapsed if elapsed else 0.0,
+            "errors": self.errors,
+        }
+
+
+class IngestJobQueue:
+    """件数上限付きの取り込みジョブキューと、workers 個のワーカー
+
+    同じ s3_key のジョブが待機中・実行中なら、新しく登録せずにそのジョブを返す。
+    終わったジョブは新しいものから max_finished 件だけ残す。
+    """
+
+    def __init__(self, handler: Callable[[IngestJob], Awaitable[None]], workers: int = 2,
+                 max_pending: int = 100, max_finished: int = 1000):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._active: Dict[str, IngestJob] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        """ワーカーを起動（イベントループ上で呼ぶ）"""
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, s3_key: str) -> IngestJob:
+        """ジョブを登録（キューが一杯なら asyncio.QueueFull）"""
+        job = self._active.get(s3_key)
+        if job is not None:
+            return job
+        if self._queue is None:
+            raise RuntimeError("ingest workers are not running")
+        job = IngestJob(s3_key)
+        self._queue.put_nowait(job)
+        self._jobs[job.job_id] = job
+        self._active[s3_key] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        counts = {QUEUED: 0, RUNNING: 0, SUCCEEDED: 0, FAILED: 0}
+        for job in self._jobs.values():
+            counts[job.status] += 1
+        return {"workers": self.workers, "max_pending": self.max_pending, **counts}
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            job.status = RUNNING
+            job.started_at = time.time()
+            try:
+                await self.handler(job)
+                job.status = SUCCEEDED
+            except asyncio.CancelledError:
+                job.status = FAILED
+                job.errors.append("cancelled")
+                raise
+            except Exception as e:
+                logger.error(f"Ingest job {job.job_id} failed: {e}")
+                job.status = FAILED
+                job.errors.append(str(e))
+            finally:
+                job.finished_at = time.time()
+                self._active.pop(job.s3_key, None)
+                self._forget_finished()
+                self._queue.task_done()
@@ -0,0 +1,328 @@
+"""
+main.py（SQLite版）用のローカルベクトルストア
+
+埋め込みは L2 正規化した float32 の行列として vectors.f32 に連続して追記し、
+チャンク本文とメタデータは同じ行順で chunks.jsonl に追記する。
+検索時は行列を np.memmap で読み、BLOCK_ROWS 行ずつの内積（= コサイン類似度）で
+上位 limit 件を求める。行列全体をプロセスのヒープに載せないので、
+件数が増えてもメモリはページキャッシュ任せになる。
+
+quantization を指定すると、圧縮した符号も別ファイルに持ち、1段目は符号だけを
+走査して limit * rerank_factor 件の候補を選ぶ。候補だけ float32 の行を読んで
+コサイン類似度で並べ直す。
+  - "int8": 行ごとのスケールで 8bit に量子化（4分の1）。近似内積で候補を選ぶ
+  - "binary": 各次元の符号 1bit（32分の1）。ハミング距離で候補を選ぶ
+
+同じ本文のチャンクは content_hash で1行にまとめ、2回目以降は追加しない。
+"""
+import json
+import os
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from embedding_cache import content_hash
+
+# 1回の内積計算で読む行数
+BLOCK_ROWS = 65536
+# 量子化符号を float32 に戻して計算するときの行数（変換後の配列がキャッシュに収まる大きさ）
+QUANTIZED_BLOCK_ROWS = 1024
+
+QUANTIZATIONS = ("none", "int8", "binary")
+
+# 16bit 中の立っているビット数（np.bitwise_count のない NumPy 1.x 用）
+_POPCOUNT16 = np.array([bin(i).count("1") for i in range(65536)], dtype=np.uint8)
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """各行を L2 正規化（ゼロベクトルはそのまま）"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """行ごとに最大絶対値が 127 になるよう量子化し、(符号, スケール) を返す"""
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def binary_code_width(dim: int) -> int:
+    """1bit 符号1行のバイト数（uint64 単位で XOR できるよう 8 バイト境界に揃える）"""
+    return (dim + 63) // 64 * 8
+
+
+def quantize_binary(vectors: np.ndarray) -> np.ndarray:
+    """各次元の符号を 1bit に詰める"""
+    bits = np.packbits(vectors > 0, axis=1)
+    padding = binary_code_width(vectors.shape[1]) - bits.shape[1]
+    return np.pad(bits, ((0, 0), (0, padding))) if padding else bits
+
+
+def hamming_distances(codes: np.ndarray, query_code: np.ndarray) -> np.ndarray:
+    """各行の符号とクエリの符号のハミング距離"""
+    diff = np.bitwise_xor(codes.view(np.uint64), query_code.view(np.uint64))
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(diff).sum(axis=1, dtype=np.int32)
+    return _POPCOUNT16[diff.view(np.uint16)].sum(axis=1, dtype=np.int32)
+
+
+def top_k_blocks(count: int, limit: int, block_scores: Callable[[int, int], np.ndarray],
+                 block_rows: int = BLOCK_ROWS) -> Tuple[np.ndarray, np.ndarray]:
+    """block_rows 行ずつスコアを計算し、上位 limit 件の (行番号, スコア) をスコア順に返す"""
+    best_rows = np.empty(0, dtype=np.int64)
+    best_scores = np.empty(0, dtype=np.float32)
+    for start in range(0, count, block_rows):
+        scores = block_scores(start, min(start + block_rows, count))
+        rows = np.arange(start, start + len(scores))
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            scores, rows = scores[top], rows[top]
+        best_scores = np.concatenate([best_scores, scores])
+        best_rows = np.concatenate([best_rows, rows])
+        if len(best_scores) > limit:
+            top = np.argpartition(-best_scores, limit - 1)[:limit]
+            best_scores, best_rows = best_scores[top], best_rows[top]
+
+    order = np.argsort(-best_scores, kind="stable")
+    return best_rows[order], best_scores[order]
+
+
+class LocalVectorStore:
+    """memmap した float32 行列とチャンクの JSON Lines によるベクトルストア"""
+
+    def __init__(self, directory: str, dim: int, quantization: str = "none", rerank_factor: int = 8):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"quantization は {', '.join(QUANTIZATIONS)} のいずれかです: {quantization}")
+        self.directory = directory
+        self.dim = dim
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._chunks_path = os.path.join(directory, "chunks.jsonl")
+        self._codes_path = os.path.join(directory, f"vectors.{quantization}")
+        self._scales_path = os.path.join(directory, "scales.f32")
+        self._lock = threading.RLock()
+        self._chunks: List[dict] = []
+        # 本文のハッシュ -> 行番号
+        self._hashes: Dict[str, int] = {}
+        self._matrix: Optional[np.memmap] = None
+        self._codes: Optional[np.memmap] = None
+        self._scales: Optional[np.memmap] = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    @property
+    def _code_width(self) -> int:
+        """符号1行のバイト数"""
+        return self.dim if self.quantization == "int8" else binary_code_width(self.dim)
+
+    def _load(self):
+        """ファイルを読み込み、書き込み途中で止まった末尾を切り詰める"""
+        if os.path.exists(self._chunks_path):
+            with open(self._chunks_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._chunks.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+
+        row_bytes = self.dim * np.dtype(np.float32).itemsize
+        vector_rows = os.path.getsize(self._vectors_path) // row_bytes if os.path.exists(self._vectors_path) else 0
+        count = min(vector_rows, len(self._chunks))
+
+        if os.path.exists(self._vectors_path) and os.path.getsize(self._vectors_path) != count * row_bytes:
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(count * row_bytes)
+        if len(self._chunks) != count:
+            self._chunks = self._chunks[:count]
+            self._rewrite_chunks()
+        for row, chunk in enumerate(self._chunks):
+            self._hashes.setdefault(content_hash(chunk["content"]), row)
+
+        if self.quantization != "none":
+            if self._file_size(self._codes_path) != count * self._code_width or (
+                self.quantization == "int8" and self._file_size(self._scales_path) != count * 4
+            ):
+                self._rebuild_codes(count)
+        self._remap()
+
+    @staticmethod
+    def _file_size(path: str) -> int:
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def _rewrite_chunks(self):
+        tmp_path = self._chunks_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for chunk in self._chunks:
+                f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self._chunks_path)
+
+    def _rebuild_codes(self, count: int):
+        """float32 の行列から符号ファイルを作り直す（量子化方式を変えたとき・書き込み途中で止まったとき）"""
+        for path in (self._codes_path, self._scales_path):
+            if os.path.exists(path):
+                os.remove(path)
+        if not count:
+            return
+        matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+        for start in range(0, count, BLOCK_ROWS):
+            self._write_codes(np.asarray(matrix[start:start + BLOCK_ROWS]))
+
+    def _write_codes(self, vectors: np.ndarray):
+        if self.quantization == "int8":
+            codes, scales = quantize_int8(vectors)
+            with open(self._scales_path, "ab") as f:
+                f.write(scales.tobytes())
+        else:
+            codes = quantize_binary(vectors)
+        with open(self._codes_path, "ab") as f:
+            f.write(codes.tobytes())
+
+    def _remap(self):
+        count = len(self._chunks)
+        self._matrix = (
+            np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+            if count else None
+        )
+        self._codes = self._scales = None
+        if count and self.quantization != "none" and os.path.exists(self._codes_path):
+            dtype = np.int8 if self.quantization == "int8" else np.uint8
+            self._codes = np.memmap(self._codes_path, dtype=dtype, mode="r", shape=(count, self._code_width))
+            if self.quantization == "int8":
+                self._scales = np.memmap(self._scales_path, dtype=np.float32, mode="r", shape=(count,))
+
+    def stored_hashes(self, hashes: Iterable[str]) -> Set[str]:
+        """hashes のうち既に保存されている本文のハッシュ"""
+        with self._lock:
+            return {h for h in hashes if h in self._hashes}
+
+    def add(self, items: Iterable[Tuple[str, dict, Sequence[float]]]) -> int:
+        """(本文, メタデータ, 埋め込み) を追記し、追加した件数を返す（保存済みの本文は飛ばす）"""
+        with self._lock:
+            hashes: Dict[str, Tuple[str, dict, Sequence[float]]] = {}
+            for item in items:
+                h = content_hash(item[0])
+                if h not in self._hashes:
+                    hashes.setdefault(h, item)
+            return self._append(hashes)
+
+    def _append(self, items: Dict[str, Tuple[str, dict, Sequence[float]]]) -> int:
+        """ハッシュ -> (本文, メタデータ, 埋め込み) を追記（ロックを持って呼ぶ）"""
+        if not items:
+            return 0
+
+        vectors = normalize_rows(np.asarray([item[2] for item in items.values()], dtype=np.float32))
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"埋め込みの次元が違います: {vectors.shape[1]} != {self.dim}")
+
+        # ベクトル・符号を先に書く（途中で止まっても _load で行数を揃える）
+        with open(self._vectors_path, "ab") as f:
+            f.write(vectors.astype(np.float32).tobytes())
+        if self.quantization != "none":
+            self._write_codes(vectors)
+        with open(self._chunks_path, "a", encoding="utf-8") as f:
+            for h, (content, metadata, _) in items.items():
+                chunk = {"content": content, "metadata": metadata}
+                f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+                self._hashes[h] = len(self._chunks)
+                self._chunks.append(chunk)
+        self._remap()
+        return len(items)
+
+    def _exact_top_k(self, matrix: np.ndarray, query: np.ndarray, limit: int) -> Tuple[np.ndarray, np.ndarray]:
+        return top_k_blocks(len(matrix), limit, lambda start, stop: matrix[start:stop] @ query)
+
+    def _quantized_top_k(self, matrix: np.ndarray, codes: np.ndarray, scales: Optional[np.ndarray],
+                         query: np.ndarray, limit: int) -> Tuple[np.ndarray, np.ndarray]:
+        """符号で候補を選び、候補だけ float32 の内積で並べ直す"""
+        if self.quantization == "int8":
+            block_rows = QUANTIZED_BLOCK_ROWS
+
+            def block_scores(start, stop):
+                return (codes[start:stop].astype(np.float32) @ query) * scales[start:stop]
+        else:
+            block_rows = BLOCK_ROWS
+            query_code = quantize_binary(query[None, :])
+
+            def block_scores(start, stop):
+                return -hamming_distances(codes[start:stop], query_code).astype(np.float32)
+
+        candidates, _ = top_k_blocks(len(codes), limit * self.rerank_factor, block_scores, block_rows)
+        # memmap は行番号順に読むほうが速い
+        candidates = np.sort(candidates)
+        scores = matrix[candidates] @ query
+        top = np.argsort(-scores, kind="stable")[:limit]
+        return candidates[top], scores[top]
+
+    def _snapshot(self):
+        with self._lock:
+            return self._matrix, self._codes, self._scales, self._chunks
+
+    def search(self, query_embedding: Sequence[float], limit: int, exact: bool = False) -> List[dict]:
+        """コサイン類似度の高い順に上位 limit 件のチャンクを返す
+
+        exact=True なら量子化していても全件を float32 で走査する。
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm:
+            query = query / query_norm
+
+        matrix, codes, scales, chunks = self._snapshot()
+        if matrix is None or limit <= 0:
+            return []
+
+        if codes is None or exact:
+            rows, scores = self._exact_top_k(matrix, query, limit)
+        else:
+            rows, scores = self._quantized_top_k(matrix, codes, scales, query, limit)
+        return [
+            {
+                "content": chunks[row]["content"],
+                "metadata": chunks[row]["metadata"],
+                "similarity_score": float(score),
+            }
+            for row, score in zip(rows.tolist(), scores.tolist())
+        ]
+
+    def recall(self, queries: np.ndarray, limit: int, exclude_rows: Optional[Sequence[int]] = None) -> float:
+        """量子化検索の上位 limit 件に全精度の上位 limit 件が含まれる割合（recall@limit）
+
+        exclude_rows はクエリごとに結果から除く行（保存済みの埋め込みをクエリにしたときの
+        その行自身。除かないクエリは -1）。自分自身は必ず1位になるので、含めると高く出る。
+        """
+        matrix, codes, scales, _ = self._snapshot()
+        if matrix is None or not len(queries):
+            return 1.0
+        if codes is None:
+            return 1.0
+        if exclude_rows is None:
+            exclude_rows = [-1] * len(queries)
+
+        found = 0
+        expected = 0
+        for query, excluded in zip(normalize_rows(np.asarray(queries, dtype=np.float32)), exclude_rows):
+            k = limit + 1 if excluded >= 0 else limit
+            exact_rows, _ = self._exact_top_k(matrix, query, k)
+            quantized_rows, _ = self._quantized_top_k(matrix, codes, scales, query, k)
+            exact_rows = exact_rows[exact_rows != excluded][:limit]
+            quantized_rows = quantized_rows[quantized_rows != excluded][:limit]
+            found += len(np.intersect1d(exact_rows, quantized_rows))
+            expected += len(exact_rows)
+        return found / expected
+
+    def sample_vectors(self, size: int, seed: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """保存済みの埋め込みから size 件を無作為に取り出し、(行番号, 埋め込み) を返す（再現率の評価用）"""
+        matrix, _, _, _ = self._snapshot()
+        if matrix is None or size <= 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=np.float32)
+        rows = np.sort(np.random.default_rng(seed).choice(len(matrix), size=min(size, len(matrix)), replace=False))
+        return rows, np.asarray(matrix[rows])
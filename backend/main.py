@@ -1,10 +1,16 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, File, HTTPException, Query, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import Session
-from typing import List
-from pydantic import BaseModel
+from typing import Dict, List, Optional
+from pydantic import BaseModel, Field
+import asyncio
 import logging
-from datetime import timedelta
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
 
 # 既存のインポート
 from database import get_db, engine
@@ -16,10 +22,20 @@ from auth import (
     create_access_token,
     get_current_user,   # 追加
 )
+from search_index import VendorSearchIndex
+from search_cache import SearchResultCache, cache_key
+from chunker import batched, chunk_text, decode_stream, read_blocks
+from embeddings import EMBEDDING_DIM, EMBEDDING_WINDOW, create_query_embedding, embed_window, query_embedding_cache
+from local_vector_store import LocalVectorStore
 
 # DB初期化
 Base.metadata.create_all(bind=engine)
 
+# create_all は既存テーブルに列を追加しないので、別名列だけ手動で追加する
+if "aliases" not in {column["name"] for column in inspect(engine).get_columns("vendors")}:
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE vendors ADD COLUMN aliases VARCHAR"))
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -36,6 +52,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ==== ベンダー検索インデックス ====
+vendor_index = VendorSearchIndex()
+search_cache = SearchResultCache(
+    max_entries=int(os.getenv("SEARCH_CACHE_SIZE", "1024")),
+    ttl_seconds=float(os.getenv("SEARCH_CACHE_TTL", "300")),
+)
+
+@app.on_event("startup")
+def build_vendor_index():
+    """起動時に有効なベンダーから検索インデックスを構築"""
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        vendors = db.query(Vendor).filter(Vendor.is_active == True).all()
+        vendor_index.build(
+            (v.id, v.name, v.category, v.description, v.website_url, v.aliases) for v in vendors
+        )
+        search_cache.invalidate()
+        logger.info(f"Vendor search index built: {len(vendor_index)} vendors")
+    finally:
+        db.close()
+
+# ==== ドキュメントのベクトルストア ====
+# Aurora（pgvector）の代わりに、ローカルディスク上の memmap 行列を使う
+# VECTOR_QUANTIZATION=int8/binary で圧縮符号による1段目の絞り込みを有効にする
+vector_store = LocalVectorStore(
+    os.getenv("VECTOR_STORE_DIR", "./vector_store"),
+    EMBEDDING_DIM,
+    quantization=os.getenv("VECTOR_QUANTIZATION", "none"),
+    rerank_factor=int(os.getenv("VECTOR_RERANK_FACTOR", "8")),
+)
+
 # ==== エンドポイント ====
 
 # ヘルスチェック
@@ -83,10 +131,23 @@ async def verify_user(current_user: dict = Depends(get_current_user)):
     """
     return {"message": "JWT is valid", "user": current_user}
 
-# ベンダー一覧取得
+# ファセット件数
+class FacetCounts(BaseModel):
+    total: int
+    facets: Dict[str, Dict[str, int]]
+
+# ベンダー一覧取得（category で絞り込み可）
 @app.get("/vendors", response_model=List[VendorResponse])
-async def get_vendors(db: Session = Depends(get_db)):
-    return db.query(Vendor).filter(Vendor.is_active == True).all()
+async def get_vendors(category: Optional[List[str]] = Query(None), db: Session = Depends(get_db)):
+    query = db.query(Vendor).filter(Vendor.is_active == True)
+    if category:
+        query = query.filter(Vendor.category.in_(category))
+    return query.all()
+
+# ベンダー一覧のファセット件数
+@app.get("/vendors/facets", response_model=FacetCounts)
+async def get_vendor_facets(category: Optional[List[str]] = Query(None)):
+    return vendor_index.facet_counts(filters={"category": category or []})
 
 # ベンダー作成
 @app.post("/vendors", response_model=VendorResponse)
@@ -95,12 +156,19 @@ async def create_vendor(vendor: VendorCreate, db: Session = Depends(get_db)):
     db.add(db_vendor)
     db.commit()
     db.refresh(db_vendor)
+    if db_vendor.is_active:
+        vendor_index.add(
+            db_vendor.id, db_vendor.name, db_vendor.category,
+            db_vendor.description, db_vendor.website_url, db_vendor.aliases
+        )
+    search_cache.invalidate()
     return db_vendor
 
 # RAG検索（簡易版）
 class SearchRequest(BaseModel):
-    query: str
-    max_results: int = 5
+    query: str = Field(..., max_length=500)
+    max_results: int = Field(5, ge=1, le=100)
+    filters: Dict[str, List[str]] = Field(default_factory=dict)
 
 class SearchResult(BaseModel):
     vendor_name: str
@@ -112,35 +180,151 @@ class SearchResult(BaseModel):
 @app.post("/search/vendors", response_model=List[SearchResult])
 async def search_vendors(search_request: SearchRequest, db: Session = Depends(get_db)):
     try:
-        query = search_request.query.lower()
-        vendors = db.query(Vendor).filter(Vendor.is_active == True).all()
-
-        results = []
-        for vendor in vendors:
-            score = 0.0
-            if query in vendor.name.lower():
-                score += 0.8
-            if query in vendor.category.lower():
-                score += 0.6
-            if vendor.description and query in vendor.description.lower():
-                score += 0.4
-
-            if score > 0:
-                results.append(SearchResult(
-                    vendor_name=vendor.name,
-                    category=vendor.category,
-                    description=vendor.description or "説明なし",
-                    score=min(score, 1.0),
-                    website_url=vendor.website_url
-                ))
-
-        results.sort(key=lambda x: x.score, reverse=True)
-        return results[:search_request.max_results]
+        key = cache_key(search_request.query, search_request.max_results, search_request.filters)
+        hits = search_cache.get(key)
+        if hits is None:
+            generation = search_cache.generation
+            hits = vendor_index.search(
+                search_request.query, search_request.max_results, search_request.filters
+            )
+            search_cache.put(key, hits, generation)
+        return [SearchResult(**hit) for hit in hits]
 
+    except ValueError as e:
+        # クエリ構文エラー
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"検索エラー: {str(e)}")
         raise HTTPException(status_code=500, detail="検索処理中にエラーが発生しました")
 
+# 検索結果キャッシュの統計
+@app.get("/search/vendors/cache")
+async def search_cache_stats():
+    return search_cache.stats()
+
+# 検索結果のファセット件数（max_results は無視してヒット全体を集計）
+@app.post("/search/vendors/facets", response_model=FacetCounts)
+async def search_vendor_facets(search_request: SearchRequest):
+    try:
+        return vendor_index.facet_counts(search_request.query, search_request.filters)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ドキュメント処理（アップロードされたファイルをローカルのベクトルストアに保存）
+@app.post("/ingest")
+async def ingest_document(file: UploadFile = File(...)):
+    try:
+        # 文の区切りでチャンクに分け、EMBEDDING_WINDOW 件ずつ埋め込み・保存する
+        # アップロードされたファイルは全体を読み込まず、ブロックごとにデコードする
+        pieces = decode_stream(read_blocks(file.file), errors='ignore')
+        windows = batched(enumerate(chunk_text(pieces)), EMBEDDING_WINDOW)
+        uploaded_at = datetime.now().isoformat()
+        total = created = embedded_count = reused = 0
+
+        async def lookup(hashes: List[str]) -> Dict[str, bool]:
+            # ローカルストアには埋め込みのある本文だけを保存している
+            return dict.fromkeys(await asyncio.to_thread(vector_store.stored_hashes, hashes), True)
+
+        while True:
+            window = await asyncio.to_thread(next, windows, None)
+            if window is None:
+                break
+            # 保存済みの本文・文書内で重複する本文は埋め込みを作らない
+            # （失敗したチャンクは検索対象にしない）
+            batch = await embed_window([chunk for _, chunk in window], lookup)
+
+            items = []
+            for j, ((i, chunk), h) in enumerate(zip(window, batch.hashes)):
+                embedding = batch.embedded.get(h)
+                if embedding is None or batch.to_embed[h] != j:
+                    continue
+                metadata = {
+                    "filename": file.filename,
+                    "chunk_index": i,
+                    "uploaded_at": uploaded_at
+                }
+                items.append((chunk, metadata, embedding))
+
+            created += await asyncio.to_thread(vector_store.add, items)
+            embedded_count += batch.embedded_count
+            reused += batch.reused_count
+            total += len(window)
+
+        logger.info(f"Document ingested: {file.filename}, {created}/{total} chunks, {embedded_count} embedded, {reused} reused")
+
+        return {
+            "message": "ドキュメントが正常に処理されました",
+            "filename": file.filename,
+            "chunks_created": created,
+            "chunks_embedded": embedded_count,
+            "chunks_reused": reused
+        }
+
+    except Exception as e:
+        logger.error(f"Ingest error: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"ドキュメント処理エラー: {str(e)}"
+        )
+
+# RAG検索機能
+@app.post("/search/documents")
+async def search_documents(query: str, limit: int = 5):
+    """ベクトル検索でドキュメントを検索"""
+    try:
+        query_embedding = await create_query_embedding(query)
+        documents = await asyncio.to_thread(vector_store.search, query_embedding, limit)
+
+        return {
+            "query": query,
+            "documents": documents,
+            "total_found": len(documents)
+        }
+
+    except Exception as e:
+        logger.error(f"Document search error: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"ドキュメント検索エラー: {str(e)}"
+        )
+
+# クエリ埋め込みキャッシュの統計
+@app.get("/search/documents/cache")
+async def embedding_cache_stats():
+    return query_embedding_cache.stats()
+
+# 量子化検索の再現率（全精度の検索結果と比べる）
+# クエリは実際に検索されたクエリの埋め込み（キャッシュ）を使い、足りない分は保存済みの埋め込みで補う
+@app.get("/search/documents/recall")
+def search_documents_recall(samples: int = Query(100, ge=1, le=1000), limit: int = Query(10, ge=1, le=100)):
+    held_out = np.asarray(query_embedding_cache.sample(samples), dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    rows, stored = vector_store.sample_vectors(samples - len(held_out), seed=0)
+    queries = np.concatenate([held_out, stored])
+    # 保存済みの埋め込みをクエリにしたときは、自分自身を正解から除く
+    exclude_rows = np.concatenate([np.full(len(held_out), -1, dtype=np.int64), rows])
+
+    started = time.perf_counter()
+    for query in queries:
+        vector_store.search(query, limit, exact=True)
+    exact_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    for query in queries:
+        vector_store.search(query, limit)
+    search_ms = (time.perf_counter() - started) * 1000
+
+    return {
+        "quantization": vector_store.quantization,
+        "rerank_factor": vector_store.rerank_factor,
+        "samples": len(queries),
+        "query_samples": len(held_out),
+        "limit": limit,
+        "recall": vector_store.recall(queries, limit, exclude_rows),
+        "exact_ms_per_query": exact_ms / len(queries) if len(queries) else 0.0,
+        "search_ms_per_query": search_ms / len(queries) if len(queries) else 0.0,
+    }
+
 # テストユーザー作成（初回用）
 def create_test_user():
     from database import SessionLocal
@@ -1,58 +1,49 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
-from pydantic import BaseModel
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+from pydantic import BaseModel, Field
 import logging
 import json
+import asyncio
+import threading
 import boto3
+import numpy as np
 import os
+import shutil
+import tempfile
+import time
+from array import array
 from datetime import datetime
-from openai import OpenAI
 from typing import List
 
 # Aurora Data API接続
-from aurora_database import get_db, execute_sql
+from aurora_database import get_db, execute_sql, execute_values, begin_transaction, commit_transaction, rollback_transaction
 from models import User, Vendor
 from schemas import UserCreate, UserResponse, VendorCreate, VendorResponse
 from auth import get_password_hash, verify_password, create_access_token
 from datetime import timedelta
+import aurora_search
+from fuzzy_index import FuzzyNameIndex, split_aliases
+from search_cache import SearchResultCache, cache_key
+from hybrid_search import reciprocal_rank_fusion
+from chunker import CHUNKER_VERSION, INGEST_READ_BYTES, batched, chunk_text, decode_stream
+from embeddings import EMBEDDING_DIM, EMBEDDING_WINDOW, create_query_embedding, embed_window, query_embedding_cache
+from hnsw_index import HNSWIndex
+from ingest_jobs import IngestJob, IngestJobQueue
+import pdf_extractor
+from starlette.requests import ClientDisconnect
+from streaming_upload import upload_form_file
 
 # S3設定
 S3_BUCKET_NAME = "vendor0913-documents"
 S3_REGION = "ap-northeast-1"
 s3_client = boto3.client('s3', region_name=S3_REGION)
 
-# OpenAI設定
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
-
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="AIベンダー調査API", version="1.0.0")
 
-# 埋め込み機能
-def create_embedding(text: str) -> List[float]:
-    """テキストをベクトル化"""
-    if not openai_client:
-        raise HTTPException(
-            status_code=500,
-            detail="OpenAI API key not configured"
-        )
-    
-    try:
-        response = openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
-        )
-        return response.data[0].embedding
-    except Exception as e:
-        logger.error(f"Embedding creation error: {e}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"埋め込み作成エラー: {str(e)}"
-        )
-
 # CORS設定
 app.add_middleware(
     CORSMiddleware,
@@ -62,6 +53,163 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ベンダー検索結果キャッシュ（ベンダーの書き込みで無効化）
+search_cache = SearchResultCache(
+    max_entries=int(os.getenv("SEARCH_CACHE_SIZE", "1024")),
+    ttl_seconds=float(os.getenv("SEARCH_CACHE_TTL", "300")),
+)
+
+# ベンダー名・別名のあいまい検索インデックス
+name_index = FuzzyNameIndex()
+
+def build_name_index():
+    """有効なベンダーの名前・別名を索引"""
+    try:
+        result = execute_sql("SELECT id, name, aliases FROM vendors WHERE is_active = true")
+        for record in result.get('records', []):
+            name_index.add(
+                record[0]['longValue'],
+                [record[1]['stringValue']] + split_aliases(record[2].get('stringValue'))
+            )
+    except Exception as e:
+        logger.error(f"Vendor name index build error: {e}")
+
+@app.on_event("startup")
+def start_name_index():
+    # ベンダー数によって時間がかかるので、起動は待たせない（構築中はあいまい検索の候補が欠ける）
+    threading.Thread(target=build_name_index, daemon=True).start()
+
+# ドキュメントのインプロセス HNSW インデックス（DOCUMENT_INDEX=hnsw のときだけ使う）
+# 構築が終わるまで（document_index が None の間）は Aurora の pgvector で検索する
+DOCUMENT_INDEX = os.getenv("DOCUMENT_INDEX", "aurora")
+HNSW_INDEX_PATH = os.getenv("HNSW_INDEX_PATH", "./hnsw_index.npz")
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "100"))
+# 他のタスクの取り込み・削除を反映するため documents と突き合わせる間隔（秒、0 で起動時だけ）
+HNSW_SYNC_INTERVAL = float(os.getenv("HNSW_SYNC_INTERVAL", "300"))
+# 1536次元の埋め込みは1行約20KBなので、Data API の応答上限（1MB）に収まる件数ずつ読む
+HNSW_SYNC_PAGE_SIZE = 40
+# 埋め込み済みの行の id を1回で読む件数
+HNSW_ID_PAGE_SIZE = 5000
+document_index: Optional[HNSWIndex] = None
+
+def fetch_embedded_ids() -> np.ndarray:
+    """埋め込みのある documents の id（昇順）"""
+    pages = []
+    after = 0
+    while True:
+        result = execute_sql(
+            "SELECT id FROM documents WHERE embedding IS NOT NULL AND id > :after ORDER BY id LIMIT :limit",
+            [
+                {"name": "after", "value": {"longValue": after}},
+                {"name": "limit", "value": {"longValue": HNSW_ID_PAGE_SIZE}}
+            ]
+        )
+        records = result.get('records', [])
+        pages.append(np.array([record[0]['longValue'] for record in records], dtype=np.int64))
+        if len(records) < HNSW_ID_PAGE_SIZE:
+            return np.concatenate(pages)
+        after = records[-1][0]['longValue']
+
+def add_document_rows(index: HNSWIndex, ids: Sequence[int]) -> int:
+    """documents の行を id 指定で読んでインデックスに追加し、件数を返す"""
+    added = 0
+    for start in range(0, len(ids), HNSW_SYNC_PAGE_SIZE):
+        page = [int(key) for key in ids[start:start + HNSW_SYNC_PAGE_SIZE]]
+        placeholders = ", ".join(f":id{i}" for i in range(len(page)))
+        result = execute_sql(
+            f"""
+            SELECT id, content, metadata, embedding::text
+            FROM documents
+            WHERE embedding IS NOT NULL AND id IN ({placeholders})
+            """,
+            [{"name": f"id{i}", "value": {"longValue": key}} for i, key in enumerate(page)]
+        )
+        for record in result.get('records', []):
+            index.add(
+                record[0]['longValue'],
+                json.loads(record[3]['stringValue']),
+                {"content": record[1]['stringValue'], "metadata": json.loads(record[2]['stringValue'])}
+            )
+            added += 1
+    return added
+
+def sync_document_index(index: HNSWIndex) -> Tuple[int, int]:
+    """documents の埋め込み済みの行と突き合わせ、(追加した件数, 取り除いた件数) を返す
+
+    後から埋め込みが付いた古い行、他のタスクで取り込み・削除された行、
+    インデックスの構築中に取り込まれた行もここで反映される。
+    """
+    # 取り込み処理はコミット後にインデックスへ追加するので、先にキーを取ってから
+    # id を読めば、キーにある行は必ず id の一覧にも入っている（削除されていなければ）
+    keys = index.keys()
+    live = fetch_embedded_ids()
+    removed = index.remove(np.setdiff1d(keys, live, assume_unique=True).tolist())
+    added = add_document_rows(index, np.setdiff1d(live, keys, assume_unique=True))
+    return added, removed
+
+def load_document_index():
+    """保存済みのインデックスを読み込み、差分を取り込んでから検索に使い始める"""
+    global document_index
+    index = None
+    if os.path.exists(HNSW_INDEX_PATH):
+        try:
+            index = HNSWIndex.load(HNSW_INDEX_PATH, ef_search=HNSW_EF_SEARCH)
+        except Exception as e:
+            logger.warning(f"HNSW index load failed, rebuilding: {e}")
+    if index is None or index.dim != EMBEDDING_DIM:
+        index = HNSWIndex(EMBEDDING_DIM, ef_construction=HNSW_EF_CONSTRUCTION, ef_search=HNSW_EF_SEARCH)
+
+    try:
+        added, removed = sync_document_index(index)
+        document_index = index
+        # 構築中（document_index が None の間）に取り込まれた行を拾う
+        caught_up, caught_up_removed = sync_document_index(index)
+        if index.modified:
+            index.save(HNSW_INDEX_PATH)
+    except Exception as e:
+        logger.error(f"HNSW index build error: {e}")
+        return
+    logger.info(
+        f"HNSW document index ready: {len(index)} chunks "
+        f"({added + caught_up} added, {removed + caught_up_removed} removed)"
+    )
+
+def run_document_index():
+    """インデックスを読み込み、以後 HNSW_SYNC_INTERVAL ごとに documents と突き合わせる
+
+    取り込みによる追加・削除も含め、変更があればそのたびにファイルへ保存する。
+    """
+    load_document_index()
+    while HNSW_SYNC_INTERVAL > 0:
+        time.sleep(HNSW_SYNC_INTERVAL)
+        if document_index is None:
+            load_document_index()
+            continue
+        try:
+            added, removed = sync_document_index(document_index)
+            if added or removed:
+                logger.info(f"HNSW document index synced: {added} added, {removed} removed")
+            if document_index.modified:
+                document_index.save(HNSW_INDEX_PATH)
+        except Exception as e:
+            logger.error(f"HNSW index sync error: {e}")
+
+@app.on_event("startup")
+def start_document_index():
+    if DOCUMENT_INDEX == "hnsw":
+        # 初回構築は件数によって時間がかかるので、起動は待たせない
+        threading.Thread(target=run_document_index, daemon=True).start()
+
+@app.on_event("shutdown")
+def save_document_index():
+    # 前回の保存より後の取り込み分を書き出す（書き出せなくても次の起動時の突き合わせで戻る）
+    if document_index is not None and document_index.modified:
+        try:
+            document_index.save(HNSW_INDEX_PATH)
+        except Exception as e:
+            logger.error(f"HNSW index save error: {e}")
+
 # ヘルスチェック
 @app.get("/health")
 async def health_check():
@@ -142,10 +290,20 @@ async def login_user(credentials: LoginRequest, db = Depends(get_db)):
 
     return {"access_token": access_token, "token_type": "bearer"}
 
-# ベンダー一覧
+# ファセット件数
+class FacetCounts(BaseModel):
+    total: int
+    facets: Dict[str, Dict[str, int]]
+
+# ベンダー一覧（category で絞り込み可）
 @app.get("/vendors", response_model=List[VendorResponse])
-async def get_vendors(db = Depends(get_db)):
-    result = execute_sql("SELECT id, name, category, description, website_url, is_active FROM vendors WHERE is_active = true")
+async def get_vendors(category: Optional[List[str]] = Query(None), db = Depends(get_db)):
+    where, parameters = aurora_search.build_where([], {"category": category or []})
+    result = await asyncio.to_thread(
+        execute_sql,
+        f"SELECT id, name, category, description, website_url, is_active, created_at FROM vendors WHERE {where}",
+        parameters
+    )
     
     vendors = []
     if result.get('records'):
@@ -154,29 +312,41 @@ async def get_vendors(db = Depends(get_db)):
                 id=record[0]['longValue'],
                 name=record[1]['stringValue'],
                 category=record[2]['stringValue'],
-                description=record[3]['stringValue'] if record[3] else None,
-                website_url=record[4]['stringValue'] if record[4] else None,
-                is_active=record[5]['booleanValue']
+                description=record[3].get('stringValue'),
+                website_url=record[4].get('stringValue'),
+                is_active=record[5]['booleanValue'],
+                created_at=record[6]['stringValue']
             ))
     
     return vendors
 
+# ベンダー一覧のファセット件数
+@app.get("/vendors/facets", response_model=FacetCounts)
+async def get_vendor_facets(category: Optional[List[str]] = Query(None), db = Depends(get_db)):
+    return await asyncio.to_thread(aurora_search.facet_counts, filters={"category": category or []})
+
 # ベンダー作成
 @app.post("/vendors", response_model=VendorResponse)
 async def create_vendor(vendor: VendorCreate, db = Depends(get_db)):
-    result = execute_sql(
-        "INSERT INTO vendors (name, category, description, website_url, is_active) VALUES (%s, %s, %s, %s, %s) RETURNING id, name, category, description, website_url, is_active",
+    result = await asyncio.to_thread(
+        execute_sql,
+        "INSERT INTO vendors (name, category, description, website_url, aliases, is_active) VALUES (:name, :category, :description, :website_url, :aliases, :is_active) RETURNING id, name, category, description, website_url, is_active",
         [
             {"name": "name", "value": {"stringValue": vendor.name}},
             {"name": "category", "value": {"stringValue": vendor.category}},
             {"name": "description", "value": {"stringValue": vendor.description or ""}},
             {"name": "website_url", "value": {"stringValue": vendor.website_url or ""}},
+            {"name": "aliases", "value": {"stringValue": vendor.aliases or ""}},
             {"name": "is_active", "value": {"booleanValue": vendor.is_active}}
         ]
     )
     
+    search_cache.invalidate()
+
     if result.get('records'):
         record = result['records'][0]
+        if record[5]['booleanValue']:
+            name_index.add(record[0]['longValue'], [vendor.name] + split_aliases(vendor.aliases))
         return VendorResponse(
             id=record[0]['longValue'],
             name=record[1]['stringValue'],
@@ -190,8 +360,9 @@ async def create_vendor(vendor: VendorCreate, db = Depends(get_db)):
 
 # RAG検索機能
 class SearchRequest(BaseModel):
-    query: str
-    max_results: int = 5
+    query: str = Field(..., max_length=500)
+    max_results: int = Field(5, ge=1, le=100)
+    filters: Dict[str, List[str]] = Field(default_factory=dict)
 
 class SearchResult(BaseModel):
     vendor_name: str
@@ -200,52 +371,34 @@ class SearchResult(BaseModel):
     score: float
     website_url: str = None
 
+def lexical_search(query: str, max_results: int, filters: Dict[str, List[str]]) -> List[dict]:
+    """ベンダーの語彙検索（結果キャッシュ・あいまい検索の切り替えを含む）"""
+    key = cache_key(query, max_results, filters)
+    hits = search_cache.get(key)
+    if hits is None:
+        # 絞り込みとランキングはAurora側で実行
+        generation = search_cache.generation
+        hits = aurora_search.search_vendors(query, max_results, filters)
+        if not hits:
+            # 一致なしは綴り間違いとみなして名前・別名のあいまい検索
+            hits = aurora_search.fuzzy_search(name_index, query, max_results, filters)
+        search_cache.put(key, hits, generation)
+    return hits
+
 @app.post("/search/vendors", response_model=List[SearchResult])
 async def search_vendors(search_request: SearchRequest, db = Depends(get_db)):
     """
     AIベンダー検索機能（RAGシステム）
     """
     try:
-        # 現在は簡単な検索
-        # 将来的なRAGシステムは後で実装
-        query = search_request.query.lower()
-
-        # ベンダー検索
-        result = execute_sql("SELECT name, category, description, website_url FROM vendors WHERE is_active = true")
-        
-        results = []
-        if result.get('records'):
-            for record in result['records']:
-                vendor_name = record[0]['stringValue']
-                category = record[1]['stringValue']
-                description = record[2]['stringValue'] if record[2] else ""
-                website_url = record[3]['stringValue'] if record[3] else None
-                
-                score = 0.0
-                
-                # 簡単なスコアリング
-                if query in vendor_name.lower():
-                    score += 0.8
-                if query in category.lower():
-                    score += 0.6
-                if description and query in description.lower():
-                    score += 0.4
-
-                if score > 0:
-                    results.append(SearchResult(
-                        vendor_name=vendor_name,
-                        category=category,
-                        description=description or "説明なし",
-                        score=min(score, 1.0),
-                        website_url=website_url
-                    ))
-
-        # スコア順でソート
-        results.sort(key=lambda x: x.score, reverse=True)
-
-        # 最大結果数で制限
-        return results[:search_request.max_results]
+        hits = await asyncio.to_thread(
+            lexical_search, search_request.query, search_request.max_results, search_request.filters
+        )
+        return [SearchResult(**hit) for hit in hits]
 
+    except ValueError as e:
+        # クエリ構文エラー
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"検索エラー: {str(e)}")
         raise HTTPException(
@@ -253,23 +406,24 @@ async def search_vendors(search_request: SearchRequest, db = Depends(get_db)):
             detail="検索処理でエラーが発生しました"
         )
 
+# 検索結果キャッシュの統計
+@app.get("/search/vendors/cache")
+async def search_cache_stats():
+    return search_cache.stats()
+
 # ドキュメントアップロード
 @app.post("/upload")
-async def upload_document(file: UploadFile = File(...)):
-    """ドキュメントをS3にアップロード"""
+async def upload_document(request: Request):
+    """ドキュメント（フォームの file）をS3にアップロード
+
+    本文を全部読み込まず、受け取りながらマルチパートアップロードで送る。
+    """
+    # ファイル名の生成（タイムスタンプ付き）
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     try:
-        # ファイル名の生成（タイムスタンプ付き）
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'txt'
-        s3_key = f"vendor0913-folder/{timestamp}_{file.filename}"
-        
-        # ファイルをS3にアップロード
-        file_content = await file.read()
-        s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=s3_key,
-            Body=file_content,
-            ContentType=file.content_type or 'application/octet-stream'
+        s3_key, filename, size = await upload_form_file(
+            request, s3_client, S3_BUCKET_NAME,
+            lambda filename: f"vendor0913-folder/{timestamp}_{filename}"
         )
         
         logger.info(f"File uploaded to S3: {s3_key}")
@@ -277,10 +431,16 @@ async def upload_document(file: UploadFile = File(...)):
         return {
             "message": "ファイルが正常にアップロードされました",
             "s3_key": s3_key,
-            "filename": file.filename,
-            "size": len(file_content)
+            "filename": filename,
+            "size": size
         }
         
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ClientDisconnect:
+        # アップロードは中止済み。応答は届かない
+        logger.warning("Upload aborted: client disconnected")
+        raise HTTPException(status_code=400, detail="アップロードが中断されました")
     except Exception as e:
         logger.error(f"Upload error: {e}")
         raise HTTPException(
@@ -288,107 +448,417 @@ async def upload_document(file: UploadFile = File(...)):
             detail=f"ファイルアップロードエラー: {str(e)}"
         )
 
+# 1回の IN 句に並べるハッシュの数
+HASH_LOOKUP_PAGE_SIZE = 100
+
+def fetch_stored_hashes(hashes: Set[str], transaction_id: Optional[str] = None) -> Dict[str, bool]:
+    """documents に既にある content_hash -> 埋め込み済みか
+
+    見つかった行は使い回すので FOR KEY SHARE でロックし、コミットまで他の文書の
+    save_manifest に削除されないようにする（削除中の行はその完了を待ってから除かれる）。
+    """
+    stored: Dict[str, bool] = {}
+    hashes = sorted(hashes)
+    for start in range(0, len(hashes), HASH_LOOKUP_PAGE_SIZE):
+        page = hashes[start:start + HASH_LOOKUP_PAGE_SIZE]
+        placeholders = ", ".join(f":h{i}" for i in range(len(page)))
+        result = execute_sql(
+            f"SELECT content_hash, embedding IS NOT NULL FROM documents WHERE content_hash IN ({placeholders}) FOR KEY SHARE",
+            [{"name": f"h{i}", "value": {"stringValue": h}} for i, h in enumerate(page)],
+            transaction_id
+        )
+        for record in result.get('records', []):
+            stored[record[0]['stringValue']] = record[1]['booleanValue']
+    return stored
+
+def save_chunks(s3_key: str, window: List[Tuple[int, str]], hashes: List[str], stored: Dict[str, bool],
+                to_embed: Dict[str, int], embedded: Dict[str, Optional[List[float]]], uploaded_at: str,
+                transaction_id: str, index_ids: Optional[array]) -> int:
+    """(チャンク番号, 本文) を documents にまとめて保存し、追加した行数を返す
+
+    同じ本文の行は content_hash の一意制約で1行にまとまる。
+    to_embed は本文のハッシュ -> window 内で最初に現れる位置。
+    HNSW インデックスにはコミット後に行を読み直して追加するので、埋め込みを保存した行の id を
+    index_ids に溜める（None なら溜めない）。
+    """
+    updates: List[Dict[str, dict]] = []
+    inserts: List[Dict[str, dict]] = []
+    for j, ((i, chunk), h) in enumerate(zip(window, hashes)):
+        # 埋め込み済みの行と、文書内で2回目以降に現れる本文は保存しない
+        if to_embed.get(h) != j:
+            continue
+        embedding = embedded.get(h)
+        metadata = {
+            "s3_key": s3_key,
+            "chunk_index": i,
+            "uploaded_at": uploaded_at
+        }
+        embedding_value = {"stringValue": json.dumps(embedding)} if embedding is not None else {"isNull": True}
+        if h in stored:
+            # 埋め込みのない既存の行は今回の埋め込みで補う
+            if embedding is not None:
+                updates.append({"content_hash": {"stringValue": h}, "embedding": embedding_value})
+            continue
+        inserts.append({
+            "content": {"stringValue": chunk},
+            "embedding": embedding_value,
+            "metadata": {"stringValue": json.dumps(metadata)},
+            "content_hash": {"stringValue": h}
+        })
+
+    records = execute_values(
+        """
+        UPDATE documents AS d SET embedding = CAST(v.embedding AS vector)
+        FROM (VALUES {values}) AS v (content_hash, embedding)
+        WHERE d.content_hash = v.content_hash AND d.embedding IS NULL
+        RETURNING d.id
+        """,
+        "(:content_hash, :embedding)",
+        updates,
+        transaction_id
+    )
+    if index_ids is not None:
+        index_ids.extend(record[0]['longValue'] for record in records)
+
+    records = execute_values(
+        """
+        INSERT INTO documents (content, embedding, metadata, content_hash)
+        VALUES {values}
+        ON CONFLICT (content_hash) DO NOTHING
+        RETURNING id, content_hash
+        """,
+        "(:content, CAST(:embedding AS vector), CAST(:metadata AS jsonb), :content_hash)",
+        inserts,
+        transaction_id
+    )
+    if index_ids is not None:
+        index_ids.extend(record[0]['longValue'] for record in records
+                         if embedded.get(record[1]['stringValue']) is not None)
+    return len(records)
+
+# 取り込み記録のチャンクを1回で読む件数
+MANIFEST_PAGE_SIZE = 1000
+
+def fetch_manifest(s3_key: str) -> Optional[dict]:
+    """前回の取り込み記録（ETag・バージョン・チャンカーの版）"""
+    result = execute_sql(
+        "SELECT etag, version_id, chunker_version FROM document_manifests WHERE s3_key = :s3_key",
+        [{"name": "s3_key", "value": {"stringValue": s3_key}}]
+    )
+    records = result.get('records', [])
+    if not records:
+        return None
+    etag, version_id, chunker_version = (field.get('stringValue') for field in records[0])
+    return {"etag": etag, "version_id": version_id, "chunker_version": chunker_version}
+
+def fetch_manifest_hashes(s3_key: str, transaction_id: str) -> Set[str]:
+    """前回の取り込みで記録した文書のチャンクの content_hash"""
+    hashes: Set[str] = set()
+    after = ""
+    while True:
+        result = execute_sql(
+            """
+            SELECT content_hash FROM document_manifest_chunks
+            WHERE s3_key = :s3_key AND content_hash > :after
+            ORDER BY content_hash
+            LIMIT :limit
+            """,
+            [
+                {"name": "s3_key", "value": {"stringValue": s3_key}},
+                {"name": "after", "value": {"stringValue": after}},
+                {"name": "limit", "value": {"longValue": MANIFEST_PAGE_SIZE}}
+            ],
+            transaction_id
+        )
+        records = result.get('records', [])
+        hashes.update(record[0]['stringValue'] for record in records)
+        if len(records) < MANIFEST_PAGE_SIZE:
+            return hashes
+        after = records[-1][0]['stringValue']
+
+def save_manifest(s3_key: str, etag: Optional[str], version_id: Optional[str],
+                  chunk_hashes: Set[str], transaction_id: str) -> List[int]:
+    """取り込み記録を更新し、どの文書にも含まれなくなったチャンクを削除してその id を返す
+
+    チャンクは本文ごとに1行で複数の文書から共有されるので、前回の記録にあって今回ない
+    チャンクのうち、他の文書の記録にも残っていないものだけを削除する。
+    etag が None の記録は次回の取り込みで必ず処理し直す。
+    """
+    # 先に記録の行を更新してロックし、同じ s3_key を同時に取り込む他のタスクのコミットを待つ。
+    # 前回のチャンクはその後に読むので、他のタスクが記録したチャンクも差分に入る
+    execute_sql(
+        """
+        INSERT INTO document_manifests (s3_key, etag, version_id, chunker_version, chunk_count, updated_at)
+        VALUES (:s3_key, :etag, :version_id, :chunker_version, :chunk_count, CURRENT_TIMESTAMP)
+        ON CONFLICT (s3_key) DO UPDATE SET
+            etag = EXCLUDED.etag,
+            version_id = EXCLUDED.version_id,
+            chunker_version = EXCLUDED.chunker_version,
+            chunk_count = EXCLUDED.chunk_count,
+            updated_at = EXCLUDED.updated_at
+        """,
+        [
+            {"name": "s3_key", "value": {"stringValue": s3_key}},
+            {"name": "etag", "value": {"stringValue": etag} if etag else {"isNull": True}},
+            {"name": "version_id", "value": {"stringValue": version_id} if version_id else {"isNull": True}},
+            {"name": "chunker_version", "value": {"stringValue": CHUNKER_VERSION}},
+            {"name": "chunk_count", "value": {"longValue": len(chunk_hashes)}}
+        ],
+        transaction_id
+    )
+    previous = fetch_manifest_hashes(s3_key, transaction_id)
+    execute_values(
+        "INSERT INTO document_manifest_chunks (s3_key, content_hash) VALUES {values} ON CONFLICT DO NOTHING",
+        "(:s3_key, :content_hash)",
+        [
+            {"s3_key": {"stringValue": s3_key}, "content_hash": {"stringValue": h}}
+            for h in sorted(chunk_hashes - previous)
+        ],
+        transaction_id
+    )
+
+    deleted: List[int] = []
+    stale = sorted(previous - chunk_hashes)
+    for start in range(0, len(stale), HASH_LOOKUP_PAGE_SIZE):
+        page = stale[start:start + HASH_LOOKUP_PAGE_SIZE]
+        placeholders = ", ".join(f":h{i}" for i in range(len(page)))
+        parameters = [{"name": f"h{i}", "value": {"stringValue": h}} for i, h in enumerate(page)]
+        execute_sql(
+            f"DELETE FROM document_manifest_chunks WHERE s3_key = :s3_key AND content_hash IN ({placeholders})",
+            [{"name": "s3_key", "value": {"stringValue": s3_key}}] + parameters,
+            transaction_id
+        )
+        # 他の文書が使い回そうとロックしている行は、その取り込みのコミットを待つ。
+        # 次の DELETE は待った後に始まるので、コミットされた取り込み記録が見える
+        execute_sql(
+            f"SELECT 1 FROM documents WHERE content_hash IN ({placeholders}) ORDER BY content_hash FOR UPDATE",
+            parameters,
+            transaction_id
+        )
+        result = execute_sql(
+            f"""
+            DELETE FROM documents d
+            WHERE d.content_hash IN ({placeholders})
+              AND NOT EXISTS (SELECT 1 FROM document_manifest_chunks c WHERE c.content_hash = d.content_hash)
+            RETURNING d.id
+            """,
+            parameters,
+            transaction_id
+        )
+        deleted.extend(record[0]['longValue'] for record in result.get('records', []))
+    return deleted
+
 # ドキュメント処理・埋め込み・保存
-@app.post("/ingest")
-async def ingest_document(s3_key: str):
-    """S3のドキュメントを処理してAuroraに保存"""
+async def process_document(job: IngestJob):
+    """S3のドキュメントを処理してAuroraに保存（進捗は job に書き込む）"""
+    s3_key = job.s3_key
+    body = None
+    pdf_file = None
+    transaction_id = None
     try:
-        # S3からファイルを取得
-        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=s3_key)
-        file_content = response['Body'].read()
+        # S3からファイルを取得（本文は読みながら処理する）
+        response = await asyncio.to_thread(s3_client.get_object, Bucket=S3_BUCKET_NAME, Key=s3_key)
+        body = response['Body']
+        
+        # 前回と同じオブジェクトを同じ切り方で取り込み済みなら何もしない
+        etag = response.get('ETag')
+        version_id = response.get('VersionId')
+        manifest = await asyncio.to_thread(fetch_manifest, s3_key)
+        if (manifest is not None and etag and manifest["etag"] == etag
+                and manifest["version_id"] == version_id and manifest["chunker_version"] == CHUNKER_VERSION):
+            job.unchanged = True
+            logger.info(f"Document unchanged, skipped: {s3_key}")
+            return
         
         # ファイルタイプに応じて処理
         if s3_key.endswith('.pdf'):
-            # PDF処理（将来実装）
-            content = f"PDF content from {s3_key}"
-        elif s3_key.endswith('.txt'):
-            content = file_content.decode('utf-8')
+            # PDF はページを読むのにファイル全体への任意のアクセスが要るので、
+            # メモリではなく一時ファイルに書き出してからページごとにプロセスプールで抽出する
+            pdf_file = tempfile.NamedTemporaryFile(suffix=".pdf")
+            await asyncio.to_thread(shutil.copyfileobj, body, pdf_file, INGEST_READ_BYTES)
+            await asyncio.to_thread(pdf_file.flush)
+            
+            def on_page(failed: bool):
+                job.pages_processed += 1
+                if failed:
+                    job.pages_failed += 1
+            pieces = pdf_extractor.extract_pages(pdf_file.name, on_page)
         else:
-            content = file_content.decode('utf-8', errors='ignore')
-        
-        # ドキュメントを分割（簡易版）
-        chunks = [content[i:i+1000] for i in range(0, len(content), 1000)]
+            errors = 'strict' if s3_key.endswith('.txt') else 'ignore'
+            pieces = decode_stream(body.iter_chunks(INGEST_READ_BYTES), errors)
         
-        # 各チャンクをデータベースに保存
-        for i, chunk in enumerate(chunks):
-            metadata = {
-                "s3_key": s3_key,
-                "chunk_index": i,
-                "total_chunks": len(chunks),
-                "uploaded_at": datetime.now().isoformat()
-            }
-            
-            # 埋め込みベクトルを作成
-            try:
-                embedding = create_embedding(chunk)
-                embedding_str = json.dumps(embedding)
-            except Exception as e:
-                logger.warning(f"Embedding creation failed for chunk {i}: {e}")
-                embedding_str = None
+        # 文の区切りでチャンクに分け、EMBEDDING_WINDOW 件ずつ埋め込み・保存する
+        # S3 の読み込みはブロックするので、次の window はスレッドで作る
+        # 文書のチャンクは1つのトランザクションでまとめて書き込む
+        windows = batched(enumerate(chunk_text(pieces)), EMBEDDING_WINDOW)
+        uploaded_at = datetime.now().isoformat()
+        # インデックスに追加する行の id（埋め込みや本文はコミット後に読み直す）
+        index_ids = array("q") if document_index is not None else None
+        chunk_hashes: Set[str] = set()
+        transaction_id = await asyncio.to_thread(begin_transaction)
+
+        async def lookup(hashes: List[str]) -> Dict[str, bool]:
+            return await asyncio.to_thread(fetch_stored_hashes, set(hashes), transaction_id)
+
+        def on_embedding_error(e: Exception):
+            logger.warning(f"Embedding creation failed for {s3_key}: {e}")
+            job.errors.append(f"埋め込み作成エラー: {str(e)}")
+
+        while True:
+            window = await asyncio.to_thread(next, windows, None)
+            if window is None:
+                break
+            # 保存済みの本文・文書内で重複する本文は埋め込みを作らない
+            # （失敗したチャンクは埋め込みなしで保存）
+            batch = await embed_window([chunk for _, chunk in window], lookup, on_embedding_error)
+            chunk_hashes.update(batch.hashes)
             
-            execute_sql(
-                "INSERT INTO documents (content, embedding, metadata) VALUES (%s, %s, %s)",
-                [
-                    {"name": "content", "value": {"stringValue": chunk}},
-                    {"name": "embedding", "value": {"stringValue": embedding_str}} if embedding_str else {"name": "embedding", "value": {"isNull": True}},
-                    {"name": "metadata", "value": {"stringValue": json.dumps(metadata)}}
-                ]
+            # Data API の呼び出しはブロックするので、保存はスレッドで行う
+            job.chunks_created += await asyncio.to_thread(
+                save_chunks, s3_key, window, batch.hashes, batch.stored, batch.to_embed, batch.embedded,
+                uploaded_at, transaction_id, index_ids
             )
+            job.chunks_embedded += batch.embedded_count
+            job.chunks_failed += batch.failed_count
+            job.chunks_reused += batch.reused_count
+            job.chunks_processed += len(window)
         
-        logger.info(f"Document ingested: {s3_key}, {len(chunks)} chunks")
+        # 埋め込みに失敗したチャンクがあれば、次回の取り込みで作り直せるよう ETag を記録しない
+        deleted_ids = await asyncio.to_thread(
+            save_manifest, s3_key, None if job.chunks_failed else etag, version_id, chunk_hashes, transaction_id
+        )
+        job.chunks_deleted = len(deleted_ids)
         
-        return {
-            "message": "ドキュメントが正常に処理されました",
-            "s3_key": s3_key,
-            "chunks_created": len(chunks)
-        }
+        await asyncio.to_thread(commit_transaction, transaction_id)
+        transaction_id = None
+        
+        # コミット済みなので、インデックスの更新に失敗してもジョブは失敗にしない
+        # （インデックスは HNSW_SYNC_INTERVAL ごとの突き合わせで追いつく）
+        # ファイルへの保存は文書ごとには行わず、突き合わせのときと終了時にまとめて行う
+        if document_index is not None and (index_ids or deleted_ids):
+            def add_to_index():
+                document_index.remove(deleted_ids)
+                add_document_rows(document_index, index_ids)
+            try:
+                await asyncio.to_thread(add_to_index)
+            except Exception as e:
+                logger.error(f"HNSW index update failed for {s3_key}: {e}")
+                job.errors.append(f"インデックス更新エラー: {str(e)}")
+        logger.info(
+            f"Document ingested: {s3_key}, {job.chunks_created}/{job.chunks_processed} chunks, "
+            f"{job.chunks_embedded} embedded, {job.chunks_reused} reused, {job.chunks_deleted} deleted"
+            + (f", {job.pages_processed} pages ({job.pages_failed} failed)" if job.pages_processed else "")
+        )
         
     except Exception as e:
         logger.error(f"Ingest error: {e}")
+        if transaction_id is not None:
+            try:
+                await asyncio.to_thread(rollback_transaction, transaction_id)
+            except Exception as rollback_error:
+                logger.error(f"Rollback failed for {s3_key}: {rollback_error}")
+        raise
+    finally:
+        if body is not None:
+            body.close()
+        if pdf_file is not None:
+            pdf_file.close()
+
+# 取り込みはワーカーで行い、/ingest はジョブを登録するだけ
+ingest_queue = IngestJobQueue(
+    process_document,
+    workers=int(os.getenv("INGEST_WORKERS", "2")),
+    max_pending=int(os.getenv("INGEST_QUEUE_SIZE", "100")),
+)
+
+@app.on_event("startup")
+async def start_ingest_workers():
+    ingest_queue.start()
+
+@app.on_event("shutdown")
+async def stop_ingest_workers():
+    await ingest_queue.stop()
+    pdf_extractor.shutdown()
+
+@app.post("/ingest", status_code=status.HTTP_202_ACCEPTED)
+async def ingest_document(s3_key: str):
+    """S3のドキュメントの取り込みジョブを登録（進捗は GET /ingest/{job_id}）"""
+    try:
+        job = ingest_queue.submit(s3_key)
+    except asyncio.QueueFull:
         raise HTTPException(
-            status_code=500,
-            detail=f"ドキュメント処理エラー: {str(e)}"
+            status_code=503,
+            detail="取り込みジョブが混み合っています。しばらくしてから再実行してください"
         )
+    return {
+        "message": "取り込みジョブを登録しました",
+        "job_id": job.job_id,
+        "s3_key": s3_key,
+        "status": job.status
+    }
+
+# 取り込みジョブの件数（状態別）
+@app.get("/ingest/stats")
+async def ingest_stats():
+    return ingest_queue.stats()
+
+# 取り込みジョブの進捗・スループット・エラー
+@app.get("/ingest/{job_id}")
+async def get_ingest_job(job_id: str):
+    job = ingest_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="取り込みジョブが見つかりません")
+    return job.to_dict()
+
+async def vector_search_documents(query: str, limit: int, ef_search: Optional[int] = None) -> List[dict]:
+    """クエリをベクトル化してコサイン距離の近いチャンクを返す"""
+    # クエリをベクトル化
+    query_embedding = await create_query_embedding(query)
+
+    # HNSW インデックスがあれば Aurora に問い合わせずに答える
+    if document_index is not None:
+        hits = await asyncio.to_thread(document_index.search, query_embedding, limit, ef_search)
+        return [dict(payload, similarity_score=similarity) for _, similarity, payload in hits]
+    query_embedding_str = json.dumps(query_embedding)
+    
+    # ベクトル検索を実行
+    result = await asyncio.to_thread(
+        execute_sql,
+        """
+        SELECT content, metadata, 
+               (embedding <=> CAST(:query_embedding AS vector)) as distance
+        FROM documents 
+        WHERE embedding IS NOT NULL
+        ORDER BY embedding <=> CAST(:query_embedding AS vector)
+        LIMIT :limit
+        """,
+        [
+            {"name": "query_embedding", "value": {"stringValue": query_embedding_str}},
+            {"name": "limit", "value": {"longValue": limit}}
+        ]
+    )
+    
+    # 結果を整形
+    documents = []
+    if result.get('records'):
+        for record in result['records']:
+            content = record[0]['stringValue']
+            metadata = json.loads(record[1]['stringValue'])
+            distance = float(record[2]['doubleValue'])
+            
+            documents.append({
+                "content": content,
+                "metadata": metadata,
+                "similarity_score": 1 - distance  # 距離を類似度に変換
+            })
+    return documents
 
 # RAG検索機能
 @app.post("/search/documents")
-async def search_documents(query: str, limit: int = 5):
-    """ベクトル検索でドキュメントを検索"""
+async def search_documents(query: str, limit: int = 5, ef_search: Optional[int] = Query(None, ge=1)):
+    """ベクトル検索でドキュメントを検索（ef_search は HNSW インデックス使用時の候補数）"""
     try:
-        # クエリをベクトル化
-        query_embedding = create_embedding(query)
-        query_embedding_str = json.dumps(query_embedding)
-        
-        # ベクトル検索を実行
-        result = execute_sql(
-            """
-            SELECT content, metadata, 
-                   (embedding <=> %s::vector) as distance
-            FROM documents 
-            WHERE embedding IS NOT NULL
-            ORDER BY embedding <=> %s::vector
-            LIMIT %s
-            """,
-            [
-                {"name": "query_embedding1", "value": {"stringValue": query_embedding_str}},
-                {"name": "query_embedding2", "value": {"stringValue": query_embedding_str}},
-                {"name": "limit", "value": {"longValue": limit}}
-            ]
-        )
-        
-        # 結果を整形
-        documents = []
-        if result.get('records'):
-            for record in result['records']:
-                content = record[0]['stringValue']
-                metadata = json.loads(record[1]['stringValue'])
-                distance = float(record[2]['doubleValue'])
-                
-                documents.append({
-                    "content": content,
-                    "metadata": metadata,
-                    "similarity_score": 1 - distance  # 距離を類似度に変換
-                })
+        documents = await vector_search_documents(query, limit, ef_search)
         
         return {
             "query": query,
@@ -403,6 +873,61 @@ async def search_documents(query: str, limit: int = 5):
             detail=f"ドキュメント検索エラー: {str(e)}"
         )
 
+# クエリ埋め込みキャッシュの統計
+@app.get("/search/documents/cache")
+async def embedding_cache_stats():
+    return query_embedding_cache.stats()
+
+# ハイブリッド検索（ベンダー語彙検索 + ドキュメントベクトル検索）
+class HybridSearchRequest(BaseModel):
+    query: str
+    max_results: int = Field(10, ge=1, le=50)
+    filters: Dict[str, List[str]] = Field(default_factory=dict)
+    lexical_weight: float = Field(1.0, ge=0)
+    vector_weight: float = Field(1.0, ge=0)
+
+@app.post("/search/hybrid")
+async def hybrid_search(search_request: HybridSearchRequest):
+    """2つの検索を並行実行し、Reciprocal Rank Fusion で1つのランキングにする"""
+    query = search_request.query
+    limit = search_request.max_results
+
+    # 統合後の上位 limit 件に入りうるのは各検索の上位 limit 件だけ
+    vendor_hits, documents = await asyncio.gather(
+        asyncio.to_thread(lexical_search, query, limit, search_request.filters),
+        vector_search_documents(query, limit),
+        return_exceptions=True,
+    )
+
+    # クエリ構文エラーはそのまま返し、それ以外は片方の結果だけで続行する
+    if isinstance(vendor_hits, ValueError):
+        raise HTTPException(status_code=400, detail=str(vendor_hits))
+    if isinstance(vendor_hits, Exception):
+        logger.warning(f"Hybrid search: vendor search failed: {vendor_hits}")
+        vendor_hits = []
+    if isinstance(documents, Exception):
+        logger.warning(f"Hybrid search: document search failed: {documents}")
+        documents = []
+
+    fused = reciprocal_rank_fusion(
+        [
+            [(("vendor", hit["vendor_name"]), {"type": "vendor", "vendor": hit}) for hit in vendor_hits],
+            [
+                (("document", doc["metadata"].get("s3_key"), doc["metadata"].get("chunk_index")),
+                 {"type": "document", "document": doc})
+                for doc in documents
+            ],
+        ],
+        weights=[search_request.lexical_weight, search_request.vector_weight],
+        limit=limit,
+    )
+
+    return {
+        "query": query,
+        "results": [dict(item, score=score) for item, score in fused],
+        "total_found": len(fused)
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -22,6 +22,7 @@ class Vendor(Base):
     description = Column(String)
     website_url = Column(String)
     contact_email = Column(String)
+    aliases = Column(String)  # 別名（カンマ区切り）
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())    
\ No newline at end of file
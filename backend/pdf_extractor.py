@@ -0,0 +1,92 @@
+"""
+PDF のテキスト抽出
+
+PDF の解析は CPU を使い続けるので、ページ範囲ごとにプロセスプールで並列に抽出する
+（API のイベントループやスレッドを GIL で止めない）。
+各ワーカーはファイルパスから PDF を開き、担当する PDF_PAGES_PER_TASK ページだけを読む。
+結果はページ順に返し、同時に抽出中の範囲はワーカー数の2倍までに抑えるので、
+ページ数が多くてもメモリに載るのは一部のページのテキストだけになる。
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Deque, Iterator, List, Optional
+
+from pypdf import PdfReader
+
+logger = logging.getLogger(__name__)
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 2)))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """プロセスプール（初回に作る。スレッドのあるプロセスを fork しないよう spawn で起動）"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def shutdown():
+    """プロセスプールを止める（アプリ終了時）"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def _extract_range(path: str, start: int, end: int) -> List[Optional[str]]:
+    """start〜end-1 ページのテキスト（抽出できなかったページは None）"""
+    reader = PdfReader(path)
+    texts: List[Optional[str]] = []
+    for number in range(start, end):
+        try:
+            texts.append(reader.pages[number].extract_text() or "")
+        except Exception:
+            texts.append(None)
+    return texts
+
+
+def page_count(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+
+def extract_pages(path: str, on_page: Optional[Callable[[bool], None]] = None) -> Iterator[str]:
+    """PDF のページのテキストをページ順に返す（ページの終わりには改行を付ける）
+
+    on_page はページごとに呼ばれ、引数は抽出に失敗したかどうか。
+    """
+    count = page_count(path)
+    executor = _get_executor()
+    pending: Deque[Future] = deque()
+    try:
+        for start in range(0, count, PDF_PAGES_PER_TASK):
+            pending.append(executor.submit(_extract_range, path, start, min(start + PDF_PAGES_PER_TASK, count)))
+            if len(pending) >= PDF_WORKERS * 2:
+                yield from _page_texts(pending.popleft(), on_page)
+        while pending:
+            yield from _page_texts(pending.popleft(), on_page)
+    finally:
+        # 途中でやめたときは、まだ始まっていない範囲を取り消す
+        for future in pending:
+            future.cancel()
+
+
+def _page_texts(future: Future, on_page: Optional[Callable[[bool], None]]) -> Iterator[str]:
+    for text in future.result():
+        if on_page is not None:
+            on_page(text is None)
+        if text:
+            yield text + "\n"
@@ -23,6 +23,7 @@ class VendorBase(BaseModel):
     description: Optional[str] = None
     website_url: Optional[str] = None
     contact_email: Optional[str] = None
+    aliases: Optional[str] = None  # 別名（カンマ区切り）
 
 class VendorCreate(VendorBase):
     pass
@@ -0,0 +1,94 @@
+"""
+/search/vendors の結果キャッシュ
+
+正規化したクエリ・max_results・絞り込み条件をキーに、件数上限付きの LRU と
+TTL で結果を保持する。ベンダーの書き込みがコミットされたら invalidate() を呼ぶ。
+
+invalidate() は世代番号を進める。検索開始時に取得した世代と put() 時の世代が
+違えば（検索中に書き込みがあれば）結果を保存しないので、このノードで古い結果が
+返ることはない。
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from vendor_query import parse_query, validate_filters
+
+
+def cache_key(query: str, max_results: int,
+              filters: Optional[Dict[str, List[str]]] = None) -> Tuple:
+    """検索条件を正規化したキャッシュキー
+
+    クエリは解析結果（小文字化・空白の正規化済み）をキーにするので、
+    表記ゆれのある同じクエリは同じキーになる。構文エラーは ValueError。
+    """
+    groups = tuple(tuple(group) for group in parse_query(query))
+    facets = tuple(sorted(
+        (field, tuple(sorted(values))) for field, values in validate_filters(filters).items()
+    ))
+    return groups, max_results, facets
+
+
+class SearchResultCache:
+    """件数上限付き LRU + TTL キャッシュ"""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # キー -> (保存時刻, 値)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """キャッシュから取得（なければ None）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any, generation: int):
+        """検索開始時の世代のままなら保存"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """すべてのエントリを破棄（ベンダーの書き込み後に呼ぶ）"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
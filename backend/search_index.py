@@ -0,0 +1,445 @@
+"""
+ベンダー検索用のインメモリ転置インデックス
+
+起動時にベンダーテーブルから構築し、ベンダー作成時に差分更新する。
+日本語は空白で単語に区切れないため、各フィールドを文字 n-gram（1〜3文字）で
+索引する。クエリは vendor_query で AND / OR / フレーズ / フィールド指定に分解し、
+各語の n-gram のポスティングリストの積集合で候補を絞ってから、AND グループ内で
+積集合、グループ間で和集合を取る。最後に残った候補だけを部分一致判定で検証する。
+
+ランキングはクエリの n-gram を語とした BM25F で行う。文書頻度やフィールド長などの
+統計量はベンダーの追加・削除のたびに更新しておき、検索時は候補をまとめて
+NumPy 配列で採点する。採点用に各ポスティングリストを ID 順の (vendor_id, tf) 配列に
+したものを必要になったときに作って保持し（追加・削除で該当分を破棄）、候補の tf は
+np.searchsorted で一度に引く。
+
+ファセット（vendor_query.FACET_FIELDS）は値ごとに vendor_id をビット位置とした
+ビットマップ（Python の int）を持ち、絞り込みと件数集計はヒット集合のビットマップとの
+AND と popcount で行う。
+
+クエリに一致するベンダーがないときは、ベンダー名・別名のあいまい検索
+（fuzzy_index）に切り替えて綴り間違いを拾う。
+"""
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from fuzzy_index import FuzzyNameIndex, normalize_name, split_aliases
+from vendor_query import FACET_FIELDS, Term, parse_query, unique_terms, validate_filters
+
+# 検索対象フィールドと BM25F のフィールド重み
+FIELD_WEIGHTS = {
+    "name": 0.8,
+    "category": 0.6,
+    "description": 0.4,
+}
+
+# BM25F パラメータ（b はフィールドごとの文書長正規化の強さ）
+BM25_K1 = 1.2
+BM25_B = {
+    "name": 0.5,
+    "category": 0.3,
+    "description": 0.75,
+}
+
+# 索引する文字 n-gram の長さ
+MIN_GRAM = 1
+MAX_GRAM = 3
+
+VendorRow = Tuple[int, str, str, Optional[str], Optional[str], Optional[str]]
+
+
+def ngrams(text: str) -> Counter:
+    """テキストに含まれる n-gram とその出現回数"""
+    grams = Counter()
+    for n in range(MIN_GRAM, MAX_GRAM + 1):
+        grams.update(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+
+def query_ngrams(query: str) -> List[str]:
+    """クエリの検索に使う n-gram（3文字以上は trigram、それ未満はクエリ全体）"""
+    n = min(len(query), MAX_GRAM)
+    if n < MIN_GRAM:
+        return []
+    return list(dict.fromkeys(query[i:i + n] for i in range(len(query) - n + 1)))
+
+
+def top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> np.ndarray:
+    """スコア上位 k 件の位置をスコア降順で返す（同点はID順）
+
+    全件をソートせず、k 番目のスコアを境に上位だけを取り出してから並べる。
+    """
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)
+        ties = ties[np.argsort(ids[ties], kind="stable")][:k - len(above)]
+        positions = np.concatenate([above, ties])
+    else:
+        positions = np.arange(len(scores))
+    return positions[np.lexsort((ids[positions], -scores[positions]))]
+
+
+def gather(sorted_ids: np.ndarray, values: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """ID 順の (sorted_ids, values) から keys の値を取り出す（ないキーは 0）"""
+    if len(sorted_ids) == 0:
+        return np.zeros(len(keys))
+    positions = np.searchsorted(sorted_ids, keys)
+    positions[positions == len(sorted_ids)] = 0
+    return np.where(sorted_ids[positions] == keys, values[positions], 0.0)
+
+
+def ids_to_bitmap(ids: Iterable[int]) -> int:
+    """vendor_id の集合をビットマップに変換"""
+    ids = np.fromiter(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return 0
+    bits = np.zeros(int(ids.max()) + 1, dtype=np.uint8)
+    bits[ids] = 1
+    return int.from_bytes(np.packbits(bits, bitorder="little").tobytes(), "little")
+
+
+def bitmap_to_ids(bitmap: int) -> List[int]:
+    """ビットマップから vendor_id のリストを取り出す"""
+    if not bitmap:
+        return []
+    raw = np.frombuffer(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(raw, bitorder="little")).tolist()
+
+
+class VendorSearchIndex:
+    """name / category / description のフィールド別 n-gram インデックス"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # vendor_id -> 表示用の値
+        self._vendors: Dict[int, dict] = {}
+        # vendor_id -> フィールド別の小文字化テキスト（検証用）
+        self._texts: Dict[int, Dict[str, str]] = {}
+        # フィールド -> n-gram -> {vendor_id: 出現回数}
+        self._postings: Dict[str, Dict[str, Dict[int, int]]] = {field: {} for field in FIELD_WEIGHTS}
+        # BM25F 用の統計量
+        self._field_lengths: Dict[str, Dict[int, int]] = {field: {} for field in FIELD_WEIGHTS}
+        self._total_lengths: Dict[str, int] = {field: 0 for field in FIELD_WEIGHTS}
+        self._doc_freqs: Dict[str, int] = {}
+        # 採点用の配列: フィールド -> n-gram -> (ID 順の vendor_id, tf)、フィールド -> (vendor_id, 文書長)
+        self._posting_arrays: Dict[str, Dict[str, Tuple[np.ndarray, np.ndarray]]] = {field: {} for field in FIELD_WEIGHTS}
+        self._length_arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        # ファセット: フィールド -> 値 -> ビットマップ
+        self._facets: Dict[str, Dict[str, int]] = {field: {} for field in FACET_FIELDS}
+        self._facet_values: Dict[int, Dict[str, str]] = {}
+        self._all_bitmap = 0
+        # ベンダー名・別名のあいまい検索
+        self._fuzzy = FuzzyNameIndex()
+
+    def __len__(self) -> int:
+        return len(self._vendors)
+
+    def build(self, rows: Iterable[VendorRow]):
+        """(id, name, category, description, website_url, aliases) の列からインデックスを作り直す"""
+        with self._lock:
+            self._vendors.clear()
+            self._texts.clear()
+            self._doc_freqs.clear()
+            self._facet_values.clear()
+            self._all_bitmap = 0
+            self._fuzzy.clear()
+            for facets in self._facets.values():
+                facets.clear()
+            for field in FIELD_WEIGHTS:
+                self._postings[field].clear()
+                self._posting_arrays[field].clear()
+                self._field_lengths[field].clear()
+                self._total_lengths[field] = 0
+            self._length_arrays.clear()
+            for row in rows:
+                self.add(*row)
+
+    def add(self, vendor_id: int, name: str, category: str,
+            description: Optional[str] = None, website_url: Optional[str] = None,
+            aliases: Optional[str] = None):
+        """ベンダーを追加（同じIDがあれば置き換え）"""
+        with self._lock:
+            if vendor_id in self._vendors:
+                self.remove(vendor_id)
+
+            self._vendors[vendor_id] = {
+                "vendor_name": name,
+                "category": category,
+                "description": description or "説明なし",
+                "website_url": website_url,
+            }
+            texts = {
+                "name": (name or "").lower(),
+                "category": (category or "").lower(),
+                "description": (description or "").lower(),
+            }
+            self._texts[vendor_id] = texts
+
+            doc_grams: Set[str] = set()
+            for field, text in texts.items():
+                postings = self._postings[field]
+                arrays = self._posting_arrays[field]
+                for gram, count in ngrams(text).items():
+                    postings.setdefault(gram, {})[vendor_id] = count
+                    arrays.pop(gram, None)
+                    doc_grams.add(gram)
+                self._field_lengths[field][vendor_id] = len(text)
+                self._total_lengths[field] += len(text)
+            self._length_arrays.clear()
+
+            for gram in doc_grams:
+                self._doc_freqs[gram] = self._doc_freqs.get(gram, 0) + 1
+
+            bit = 1 << vendor_id
+            facet_values = {"category": category}
+            self._facet_values[vendor_id] = facet_values
+            for field, value in facet_values.items():
+                facets = self._facets[field]
+                facets[value] = facets.get(value, 0) | bit
+            self._all_bitmap |= bit
+
+            self._fuzzy.add(vendor_id, [name] + split_aliases(aliases))
+
+    def remove(self, vendor_id: int):
+        """ベンダーをインデックスから削除"""
+        with self._lock:
+            texts = self._texts.pop(vendor_id, None)
+            self._vendors.pop(vendor_id, None)
+            if texts is None:
+                return
+
+            doc_grams: Set[str] = set()
+            for field, text in texts.items():
+                postings = self._postings[field]
+                arrays = self._posting_arrays[field]
+                for gram in ngrams(text):
+                    doc_grams.add(gram)
+                    arrays.pop(gram, None)
+                    counts = postings.get(gram)
+                    if counts is None:
+                        continue
+                    counts.pop(vendor_id, None)
+                    if not counts:
+                        del postings[gram]
+                self._total_lengths[field] -= self._field_lengths[field].pop(vendor_id, 0)
+            self._length_arrays.clear()
+
+            for gram in doc_grams:
+                df = self._doc_freqs.get(gram, 0) - 1
+                if df > 0:
+                    self._doc_freqs[gram] = df
+                else:
+                    self._doc_freqs.pop(gram, None)
+
+            mask = ~(1 << vendor_id)
+            for field, value in self._facet_values.pop(vendor_id, {}).items():
+                facets = self._facets[field]
+                bitmap = facets.get(value, 0) & mask
+                if bitmap:
+                    facets[value] = bitmap
+                else:
+                    facets.pop(value, None)
+            self._all_bitmap &= mask
+            self._fuzzy.remove(vendor_id)
+
+    def _candidates(self, field: str, grams: List[str]) -> Set[int]:
+        """クエリの n-gram をすべて含むベンダーIDの集合"""
+        postings = self._postings[field]
+        gram_sets = []
+        for gram in grams:
+            counts = postings.get(gram)
+            if not counts:
+                return set()
+            gram_sets.append(counts.keys())
+
+        # 小さい集合から積集合を取る
+        gram_sets.sort(key=len)
+        candidates = set(gram_sets[0])
+        for ids in gram_sets[1:]:
+            candidates &= ids
+            if not candidates:
+                break
+        return candidates
+
+    def _term_candidates(self, term: Term) -> Set[int]:
+        """語を含む可能性があるベンダーIDの集合（未検証）"""
+        grams = query_ngrams(term.text)
+        candidates: Set[int] = set()
+        for field in term.fields:
+            candidates |= self._candidates(field, grams)
+        return candidates
+
+    def _match_group(self, group: List[Term]) -> Set[int]:
+        """AND グループのすべての語を含むベンダーIDの集合"""
+        # 候補の少ない語から積集合を取り、残ったものだけを検証する
+        term_sets = sorted((self._term_candidates(term) for term in group), key=len)
+        candidates = term_sets[0]
+        for ids in term_sets[1:]:
+            if not candidates:
+                break
+            candidates &= ids
+
+        texts = self._texts
+        return {
+            vendor_id for vendor_id in candidates
+            if all(
+                any(term.text in texts[vendor_id][field] for field in term.fields)
+                for term in group
+            )
+        }
+
+    def _posting_array(self, field: str, gram: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """n-gram のポスティングリストの (ID 順の vendor_id, tf) 配列"""
+        arrays = self._posting_arrays[field].get(gram)
+        if arrays is None:
+            counts = self._postings[field].get(gram)
+            if not counts:
+                return None
+            ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            tfs = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+            order = np.argsort(ids)
+            arrays = self._posting_arrays[field][gram] = (ids[order], tfs[order])
+        return arrays
+
+    def _length_array(self, field: str) -> Tuple[np.ndarray, np.ndarray]:
+        """フィールドの (ID 順の vendor_id, 文書長) 配列"""
+        arrays = self._length_arrays.get(field)
+        if arrays is None:
+            lengths = self._field_lengths[field]
+            ids = np.fromiter(lengths.keys(), dtype=np.int64, count=len(lengths))
+            values = np.fromiter(lengths.values(), dtype=np.float64, count=len(lengths))
+            order = np.argsort(ids)
+            arrays = self._length_arrays[field] = (ids[order], values[order])
+        return arrays
+
+    def _bm25f(self, vendor_ids: List[int], terms: List[Term]) -> np.ndarray:
+        """候補ベンダーの BM25F スコアをまとめて計算（語ごとのスコアの和）"""
+        doc_count = len(self._vendors)
+        size = len(vendor_ids)
+        candidates = np.fromiter(vendor_ids, dtype=np.int64, count=size)
+
+        # フィールドごとの重み付き文書長正規化
+        norms = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            avg_length = max(self._total_lengths[field] / doc_count, 1.0)
+            doc_lengths = gather(*self._length_array(field), candidates)
+            b = BM25_B[field]
+            norms[field] = weight / (1.0 - b + b * doc_lengths / avg_length)
+
+        scores = np.zeros(size)
+        for term in terms:
+            grams = query_ngrams(term.text)
+
+            # n-gram x 候補 の重み付き正規化 tf
+            weighted_tf = np.zeros((len(grams), size))
+            for field in term.fields:
+                for row, gram in enumerate(grams):
+                    arrays = self._posting_array(field, gram)
+                    if arrays is None:
+                        continue
+                    weighted_tf[row] += gather(*arrays, candidates) * norms[field]
+
+            df = np.fromiter((self._doc_freqs.get(g, 0) for g in grams), dtype=np.float64, count=len(grams))
+            idf = np.log1p((doc_count - df + 0.5) / (df + 0.5))
+            scores += (idf[:, None] * weighted_tf / (BM25_K1 + weighted_tf)).sum(axis=0)
+        return scores
+
+    def _filter_bitmap(self, filters: Dict[str, List[str]], exclude: Optional[str] = None) -> Optional[int]:
+        """絞り込み条件のビットマップ（フィールド内は OR、フィールド間は AND）"""
+        allowed = None
+        for field, values in filters.items():
+            if field == exclude:
+                continue
+            facets = self._facets[field]
+            bitmap = 0
+            for value in values:
+                bitmap |= facets.get(value, 0)
+            allowed = bitmap if allowed is None else allowed & bitmap
+        return allowed
+
+    def _match(self, groups: List[List[Term]]) -> Set[int]:
+        """解析済みクエリに一致するベンダーIDの集合"""
+        matched: Set[int] = set()
+        for group in groups:
+            matched |= self._match_group(group)
+        return matched
+
+    def search(self, query: str, max_results: int,
+               filters: Optional[Dict[str, List[str]]] = None) -> List[dict]:
+        """クエリに一致するベンダーを BM25F スコア順に返す
+
+        スコアは最上位のベンダーを 1.0 とした相対値。
+        クエリの構文は vendor_query を参照（構文エラーは ValueError）。
+        """
+        groups = parse_query(query)
+        filters = validate_filters(filters)
+        if not groups or max_results <= 0:
+            return []
+
+        with self._lock:
+            matched = self._match(groups)
+            allowed = self._filter_bitmap(filters)
+            if allowed is None:
+                vendor_ids = list(matched)
+            else:
+                vendor_ids = bitmap_to_ids(ids_to_bitmap(matched) & allowed)
+            if not vendor_ids:
+                return self._fuzzy_search(query, max_results, allowed)
+
+            # 上位 max_results 件だけを選んで結果を組み立てる
+            scores = self._bm25f(vendor_ids, unique_terms(groups))
+            order = top_k(scores, np.fromiter(vendor_ids, dtype=np.int64, count=len(vendor_ids)), max_results)
+            top_score = scores[order[0]]
+            return [
+                dict(self._vendors[vendor_ids[i]], score=float(scores[i] / top_score))
+                for i in order
+            ]
+
+    def _fuzzy_search(self, query: str, max_results: int, allowed: Optional[int]) -> List[dict]:
+        """名前・別名のあいまい検索（スコアは 1 - 距離 / 文字数）"""
+        query = normalize_name(query)
+        results = []
+        for vendor_id, distance, name in self._fuzzy.lookup(query):
+            if allowed is not None and not (allowed >> vendor_id) & 1:
+                continue
+            score = 1.0 - distance / max(len(query), len(name))
+            results.append(dict(self._vendors[vendor_id], score=score))
+            if len(results) >= max_results:
+                break
+        return results
+
+    def facet_counts(self, query: Optional[str] = None,
+                     filters: Optional[Dict[str, List[str]]] = None) -> dict:
+        """ヒット件数とファセットごとの値別件数（クエリなしは全ベンダーが対象）
+
+        各ファセットの件数はそのファセット自身の絞り込みを除いて数えるので、
+        選択中の値以外の件数も返る。
+        """
+        groups = parse_query(query) if query else None
+        filters = validate_filters(filters)
+
+        with self._lock:
+            hits = self._all_bitmap if groups is None else ids_to_bitmap(self._match(groups))
+            allowed = self._filter_bitmap(filters)
+            total = (hits if allowed is None else hits & allowed).bit_count()
+
+            facets = {}
+            for field, values in self._facets.items():
+                base = hits
+                others = self._filter_bitmap(filters, exclude=field)
+                if others is not None:
+                    base &= others
+                counts = {}
+                for value, bitmap in values.items():
+                    count = (base & bitmap).bit_count()
+                    if count:
+                        counts[value] = count
+                facets[field] = dict(sorted(counts.items(), key=lambda x: (-x[1], x[0])))
+
+        return {"total": total, "facets": facets}
@@ -0,0 +1,180 @@
+"""
+multipart/form-data のファイルを S3 へストリーミングでアップロード
+
+リクエスト本文を受け取りながら python-multipart で解析し、ファイルの中身を
+UPLOAD_PART_SIZE ごとに S3 マルチパートアップロードのパートとして送る。
+パートは UPLOAD_CONCURRENCY 個まで並行して送り、それ以上はパートの送信が
+終わるまで本文の読み込みを待つので、1アップロードあたりのメモリは
+およそ UPLOAD_PART_SIZE * (UPLOAD_CONCURRENCY + 1) で一定になる。
+途中で失敗したり切断されたりしたら、マルチパートアップロードを中止する。
+"""
+import asyncio
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+# S3 のパートは最後を除き 5 MiB 以上
+MIN_PART_SIZE = 5 * 1024 * 1024
+UPLOAD_PART_SIZE = max(MIN_PART_SIZE, int(os.getenv("UPLOAD_PART_SIZE", str(8 * 1024 * 1024))))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+
+
+class S3MultipartWriter:
+    """S3 マルチパートアップロードに順に書き込む"""
+
+    def __init__(self, s3_client, bucket: str, key: str, content_type: str,
+                 part_size: int = UPLOAD_PART_SIZE, concurrency: int = UPLOAD_CONCURRENCY):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.part_size = part_size
+        self.size = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._buffer = bytearray()
+        self._upload_id: Optional[str] = None
+        self._tasks: List[asyncio.Task] = []
+        self._etags: Dict[int, str] = {}
+
+    async def start(self):
+        response = await asyncio.to_thread(
+            self.s3_client.create_multipart_upload,
+            Bucket=self.bucket, Key=self.key, ContentType=self.content_type
+        )
+        self._upload_id = response['UploadId']
+
+    async def write(self, data: bytes):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            await self._submit(part)
+
+    async def _submit(self, data: bytes):
+        # 送信中のパートが上限に達していたら空くまで待つ（その間は本文を読まない）
+        await self._slots.acquire()
+        for task in self._tasks:
+            if task.done() and task.exception() is not None:
+                self._slots.release()
+                raise task.exception()
+        number = len(self._tasks) + 1
+        self._tasks.append(asyncio.create_task(self._upload_part(number, data)))
+
+    async def _upload_part(self, number: int, data: bytes):
+        try:
+            response = await asyncio.to_thread(
+                self.s3_client.upload_part,
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                PartNumber=number, Body=data
+            )
+            self._etags[number] = response['ETag']
+        finally:
+            self._slots.release()
+
+    async def complete(self):
+        """残りを最後のパートとして送り、アップロードを完了する"""
+        if self._buffer or not self._tasks:
+            await self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        await asyncio.gather(*self._tasks)
+        await asyncio.to_thread(
+            self.s3_client.complete_multipart_upload,
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            MultipartUpload={"Parts": [
+                {"PartNumber": number, "ETag": self._etags[number]} for number in sorted(self._etags)
+            ]}
+        )
+
+    async def abort(self):
+        """送信中のパートを待ってからアップロードを中止する（送信済みのパートも削除される）"""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._buffer.clear()
+        if self._upload_id is not None:
+            await asyncio.to_thread(
+                self.s3_client.abort_multipart_upload,
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+
+
+async def upload_form_file(request: Request, s3_client, bucket: str,
+                           make_key: Callable[[str], str], field: str = "file") -> Tuple[str, str, int]:
+    """フォームの field のファイルを S3 にアップロードし、(キー, ファイル名, バイト数) を返す
+
+    make_key はファイル名から S3 のキーを作る。フォームが不正なら ValueError。
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise ValueError("multipart/form-data で送信してください")
+
+    # パーサのコールバックはイベントとして溜め、本文の断片ごとに非同期で処理する
+    events: List[Tuple[str, bytes]] = []
+    parser = MultipartParser(boundary, callbacks={
+        "on_part_begin": lambda: events.append(("part_begin", b"")),
+        "on_part_data": lambda data, start, end: events.append(("part_data", data[start:end])),
+        "on_header_field": lambda data, start, end: events.append(("header_field", data[start:end])),
+        "on_header_value": lambda data, start, end: events.append(("header_value", data[start:end])),
+        "on_header_end": lambda: events.append(("header_end", b"")),
+        "on_headers_finished": lambda: events.append(("headers_finished", b"")),
+        "on_part_end": lambda: events.append(("part_end", b"")),
+    })
+
+    writer: Optional[S3MultipartWriter] = None
+    filename = ""
+    headers: Dict[bytes, bytes] = {}
+    header_field = header_value = b""
+    # 今のパートがアップロード対象のファイルか
+    writing = False
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for kind, data in events:
+                if kind == "part_begin":
+                    headers, header_field, header_value = {}, b"", b""
+                elif kind == "header_field":
+                    header_field += data
+                elif kind == "header_value":
+                    header_value += data
+                elif kind == "header_end":
+                    headers[header_field.lower()] = header_value
+                    header_field, header_value = b"", b""
+                elif kind == "headers_finished":
+                    _, disposition = parse_options_header(headers.get(b"content-disposition", b""))
+                    writing = (writer is None and disposition.get(b"name") == field.encode()
+                               and b"filename" in disposition)
+                    if writing:
+                        filename = os.path.basename(disposition[b"filename"].decode("utf-8", errors="replace"))
+                        if not filename:
+                            raise ValueError("ファイル名がありません")
+                        writer = S3MultipartWriter(
+                            s3_client, bucket, make_key(filename),
+                            headers.get(b"content-type", b"application/octet-stream").decode("latin-1")
+                        )
+                        await writer.start()
+                elif kind == "part_data":
+                    if writing:
+                        await writer.write(data)
+                elif kind == "part_end":
+                    writing = False
+            events.clear()
+        parser.finalize()
+
+        if writer is None:
+            raise ValueError(f"{field} にファイルがありません")
+        await writer.complete()
+        return writer.key, filename, writer.size
+
+    except BaseException:
+        # 切断（ClientDisconnect）・キャンセル・S3 のエラーなど、完了しなかったら必ず中止する
+        if writer is not None:
+            try:
+                await writer.abort()
+            except Exception as e:
+                logger.error(f"Multipart upload abort failed for {writer.key}: {e}")
+        raise
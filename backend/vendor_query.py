@@ -0,0 +1,75 @@
+"""
+ベンダー検索のクエリ言語
+
+  契約 AI                  -> 「契約」かつ「ai」（空白区切りは AND）
+  契約 OR チャットボット    -> どちらか
+  "英文 契約"              -> 空白を含むフレーズ
+  category:チャットボット   -> フィールド指定（name / category / description）
+
+AND は OR より強く結合する。括弧はサポートしないので、クエリは常に
+「AND でつないだ語のグループ」を OR でつないだ形（選言標準形）になる。
+各語はこれまでどおり小文字化した部分一致で評価する。
+"""
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# フィールド指定なしの語が対象にするフィールド
+SEARCH_FIELDS = ("name", "category", "description")
+
+# 絞り込み（ファセット）に使えるフィールド
+FACET_FIELDS = ("category",)
+
+# 1クエリあたりの語数の上限
+MAX_QUERY_TERMS = 16
+
+_TOKEN_PATTERN = re.compile(
+    r'(?:(name|category|description):)?(?:"([^"]*)"?|(\S+))',
+    re.IGNORECASE,
+)
+
+
+class Term(NamedTuple):
+    """検索語（fields のいずれかに text を部分文字列として含めば一致）"""
+    fields: Tuple[str, ...]
+    text: str
+
+
+def parse_query(query: str) -> List[List[Term]]:
+    """クエリを AND グループのリスト（OR で結合）に変換"""
+    groups: List[List[Term]] = [[]]
+    term_count = 0
+
+    for match in _TOKEN_PATTERN.finditer(query):
+        field, phrase, word = match.groups()
+        if field is None and phrase is None and word == "OR":
+            if groups[-1]:
+                groups.append([])
+            continue
+
+        text = (phrase if phrase is not None else word).lower()
+        if not text:
+            continue
+
+        term_count += 1
+        if term_count > MAX_QUERY_TERMS:
+            raise ValueError(f"検索語は{MAX_QUERY_TERMS}個までです")
+
+        fields = (field.lower(),) if field else SEARCH_FIELDS
+        groups[-1].append(Term(fields, text))
+
+    return [group for group in groups if group]
+
+
+def unique_terms(groups: List[List[Term]]) -> List[Term]:
+    """全グループに現れる語を重複なしで出現順に返す"""
+    return list(dict.fromkeys(term for group in groups for term in group))
+
+
+def validate_filters(filters: Optional[Dict[str, List[str]]]) -> Dict[str, List[str]]:
+    """ファセット絞り込み条件を検証（空の条件は取り除く）"""
+    if not filters:
+        return {}
+    unknown = [field for field in filters if field not in FACET_FIELDS]
+    if unknown:
+        raise ValueError(f"絞り込みできないフィールドです: {', '.join(unknown)}")
+    return {field: list(dict.fromkeys(values)) for field, values in filters.items() if values}